@@ -2,15 +2,24 @@ import streamlit as st
 import pandas as pd
 import json
 import io
+import csv
+import hashlib
+import gzip
+import functools
+import re
 import asyncio # For async API calls
+import threading
+import concurrent.futures
+import time
+import collections
 import numpy as np # For financial calculations
 
 # Gemini API のための設定（APIキーはCanvas環境で自動的に提供されます）
 # StreamlitのPythonバックエンドから直接APIを呼び出す形式で実装します。
 
 # --- 初期データ設定 ---
-def get_initial_data():
-    """標準的なライフプランの初期データを返します。"""
+def _build_initial_data():
+    """標準的なライフプランの初期データを構築します。"""
     return {
         "family": {
             "members": [ # 家族構成をリストで管理
@@ -85,7 +94,16 @@ def get_initial_data():
         }
     }
 
+# 初期データはモジュール読み込み時に一度だけ構築し、JSON文字列として保持する
+_INITIAL_DATA_JSON = json.dumps(_build_initial_data())
+
+def get_initial_data():
+    """標準的なライフプランの初期データを返します。呼び出し側で変更できるよう、毎回新しい辞書を返します。"""
+    return json.loads(_INITIAL_DATA_JSON)
+
 # --- 住宅ローン月額返済額計算 ---
+# 入力表示とシミュレーションの両方から同じ引数で呼ばれるため、結果をメモ化する
+@functools.lru_cache(maxsize=64)
 def calculate_monthly_loan_payment(loan_amount_man, annual_interest_rate, loan_term_years):
     """
     住宅ローンの月額返済額を計算します。(万円単位の入力)
@@ -105,13 +123,53 @@ def calculate_monthly_loan_payment(loan_amount_man, annual_interest_rate, loan_t
         # P = Principal (loan_amount_yen)
         # i = monthly interest rate
         # n = number of payments
-        return loan_amount_yen * (monthly_interest_rate * (1 + monthly_interest_rate)**num_payments) / ((1 + monthly_interest_rate)**num_payments - 1)
+        compound_factor = (1 + monthly_interest_rate)**num_payments # (1 + i)^n は一度だけ計算する
+        return loan_amount_yen * monthly_interest_rate * compound_factor / (compound_factor - 1)
+
+# --- 年齢による設定値の切り替え ---
+def apply_age_changes(base_values, years, config, key, change_years, unit=1):
+    """
+    60歳/65歳時の設定値が0でない場合、到達年以降の値をその設定値で置き換えます。
+    change_years は {60: 到達年, 65: 到達年} の形式で渡します。
+    """
+    values = base_values
+    for age, change_year in change_years.items():
+        age_value = config.get(f"{key}_at_{age}", 0)
+        if age_value > 0:
+            values = np.where(years >= change_year, age_value * unit, values)
+    return values
 
 # --- ライフプランシミュレーションロジック ---
+def freeze_data(data):
+    """ライフプランデータを、キャッシュのキーとして使える正規化済みのJSON文字列に変換します。"""
+    return json.dumps(data, sort_keys=True, ensure_ascii=False, separators=(',', ':'))
+
+def hash_data(data):
+    """ライフプランデータの内容から、キャッシュのキー用の短いハッシュ値 (blake2b) を求めます。"""
+    return hashlib.blake2b(freeze_data(data).encode('utf-8'), digest_size=16).hexdigest()
+
+def hash_simulation_df(simulation_df):
+    """シミュレーション結果の値と列名から、キャッシュのキー用の短いハッシュ値 (blake2b) を求めます。"""
+    hasher = hashlib.blake2b(digest_size=16)
+    hasher.update(pd.util.hash_pandas_object(simulation_df, index=True).to_numpy().tobytes())
+    hasher.update("\0".join(simulation_df.columns).encode('utf-8'))
+    return hasher.hexdigest()
+
 def simulate_life_plan(data):
     """
     入力データに基づいてライフプランをシミュレーションします。
+    同じ入力に対する結果はキャッシュされ、再実行時には再計算されません。
+    """
+    return _simulate_life_plan_cached(freeze_data(data))
+
+@st.cache_data(max_entries=32, show_spinner=False)
+def _simulate_life_plan_cached(data_json):
+    return _simulate_life_plan_impl(json.loads(data_json))
+
+def _simulate_life_plan_impl(data):
+    """
     年間収入、年間支出、住宅ローン額、学校一時金、年間収支、年末資産を計算します。
+    年ごとのループは使わず、各項目をシミュレーション年数分のNumPy配列としてまとめて計算します。
     """
     family = data["family"]
     income_config = data["income"]
@@ -128,214 +186,157 @@ def simulate_life_plan(data):
     income_growth_rate = family["income_growth_rate"]
     income_growth_step_years = family["income_growth_step_years"]
 
-    results = []
-    current_assets = initial_assets
+    years = np.arange(1, years_to_simulate + 1, dtype=np.int64) # シミュレーション年 (1年目から)
 
-    # 現在の収入と支出を追跡するための変数 (円単位、千円単位)
-    # これらはシミュレーション中に年齢に応じて変化する可能性がある
-    current_monthly_salary_main_yen = income_config["monthly_salary_main"] * 10000
-    current_monthly_salary_sub_yen = income_config["monthly_salary_sub"] * 10000
-    current_bonus_annual_yen = income_config["bonus_annual"] * 10000
+    # 家族メンバーの初期年齢 (名前ごと)。各年の開始時の年齢は initial_age + years - 1
+    member_initial_ages = {member["name"]: member["initial_age"] for member in family["members"]}
 
+    # 年齢による収入・支出変化の発生年
+    # family["members"]リストの最初のメンバーが60歳/65歳に到達する年を基準とします。
+    # メンバーがいない場合は期間内に変化は発生しません。
+    if family["members"]:
+        first_member_initial_age = member_initial_ages[family["members"][0]["name"]]
+        change_years = {60: max(1, 61 - first_member_initial_age), 65: max(1, 66 - first_member_initial_age)}
+    else:
+        change_years = {60: years_to_simulate + 1, 65: years_to_simulate + 1}
+
+    # 収入の上昇率をステップ年数ごとに考慮 (60歳の変化が発生した年以降は上昇しない)
+    growth_steps = (np.minimum(years, change_years[60]) - 1) // income_growth_step_years
+    income_growth_factor = (1 + income_growth_rate) ** growth_steps
+
+    # 60歳/65歳時の収入が設定されている場合は、その設定が優先される (円)
+    monthly_salary_main_yen = apply_age_changes(income_config["monthly_salary_main"] * 10000 * income_growth_factor, years, income_config, "monthly_salary_main", change_years, unit=10000)
+    monthly_salary_sub_yen = apply_age_changes(income_config["monthly_salary_sub"] * 10000 * income_growth_factor, years, income_config, "monthly_salary_sub", change_years, unit=10000)
+    bonus_annual_yen = apply_age_changes(income_config["bonus_annual"] * 10000 * income_growth_factor, years, income_config, "bonus_annual", change_years, unit=10000)
+
+    # 保険設定を並列配列に変換し、(年数 × 保険数) の配列でまとめて判定する
+    policy_start_years = np.array([policy["start_year"] for policy in insurance_policies], dtype=np.int64)
+    policy_maturity_years = np.array([policy["maturity_year"] for policy in insurance_policies], dtype=np.int64)
+    policy_monthly_premiums = np.array([policy["monthly_premium"] for policy in insurance_policies], dtype=np.int64)
+    policy_payouts_yen = np.array([policy["payout_amount"] * 10000 for policy in insurance_policies], dtype=np.int64) # 万円を円に
+    policy_end_years = policy_start_years + policy_maturity_years
+    years_col = years[:, np.newaxis]
+
+    # 満期保険の受取 (円) - 収入に加算
+    # 満期年数が設定されており、かつ「支払い開始年 + 満期年数」の年に受け取る
+    paid_out = (policy_maturity_years > 0) & (policy_end_years >= 1) & (policy_end_years <= years_to_simulate)
+    annual_insurance_payout_yen = np.bincount(policy_end_years[paid_out], weights=policy_payouts_yen[paid_out], minlength=years_to_simulate + 1)[1:]
+
+    # 保険料の年間支出 (円) - インフレ適用なし
+    # 支払い開始年以降、かつ満期年数に達していない場合のみ支払い
+    premium_paying = (policy_start_years <= years_col) & (years_col < policy_end_years)
+    annual_insurance_premium_yen = (premium_paying * policy_monthly_premiums * 12).sum(axis=1)
+
+    # 年間収入の計算 (円)
+    annual_income_yen = (monthly_salary_main_yen + monthly_salary_sub_yen) * 12 + bonus_annual_yen + annual_insurance_payout_yen
+
+    # 住宅ローンの返済期間 (ローン開始年以降、かつ返済期間内)
+    loan_active = (housing_loan["loan_amount"] > 0) & (housing_loan["start_year"] <= years) & ((years - housing_loan["start_year"] + 1) <= housing_loan["loan_term_years"])
+
+    # 月額支出合計 (千円)
+    # 各項目の値は期間 (60歳到達前 / 60歳以降 / 65歳以降) ごとに一定なので、
+    # 期間ごとの合計を一度だけ求めてから年数分に展開する
     current_expenditure_values_thousand_yen = {k: v for k, v in expenditure_config.items() if not k.endswith(('_at_60', '_at_65'))}
-
-
-    # 家族メンバーの現在の年齢を追跡 (シミュレーション開始時の年齢をコピー)
-    member_current_ages_in_sim = {member["name"]: member["initial_age"] for member in family["members"]}
-
-    # 年齢による収入・支出変化のフラグ
-    income_exp_changed_at_60 = False
-    income_exp_changed_at_65 = False
-
-    # 住宅ローンの月額返済額を事前に計算 (円)
-    # monthly_loan_payment_yen はシミュレーションのスコープ内で利用されるため、ここで定義
-    monthly_loan_payment_yen_in_sim = calculate_monthly_loan_payment(
+    period_housing_thousand_yen = []
+    period_other_exp_thousand_yen = []
+    for age in (None, 60, 65):
+        if age is not None:
+            # 60歳/65歳時の支出を適用 (0でない場合のみ)
+            for key_exp in current_expenditure_values_thousand_yen:
+                if expenditure_config.get(f"{key_exp}_at_{age}", 0) > 0:
+                    current_expenditure_values_thousand_yen[key_exp] = expenditure_config[f"{key_exp}_at_{age}"]
+        period_housing_thousand_yen.append(current_expenditure_values_thousand_yen.get('housing', 0))
+        period_other_exp_thousand_yen.append(sum(v for k, v in current_expenditure_values_thousand_yen.items() if k != 'housing'))
+    period_index = (years >= change_years[60]).astype(np.int64) + (years >= change_years[65])
+
+    # 住宅ローンがアクティブな年は、住宅ローンでカバーされるため住宅費は加算しない
+    housing_thousand_yen = np.where(loan_active, 0, np.array(period_housing_thousand_yen)[period_index])
+    base_monthly_exp_thousand_yen = np.array(period_other_exp_thousand_yen)[period_index] + housing_thousand_yen
+
+    # 月額支出合計にのみインフレ率を適用し、年間支出に変換
+    inflation_factor = (1 + inflation_rate) ** (years - 1)
+    inflated_base_annual_expenditure_yen = (base_monthly_exp_thousand_yen * 1000 * 12) * inflation_factor
+    # シミュレーション結果表示用のインフレ適用後の月額支出
+    inflated_monthly_expenditure_for_display_yen = (base_monthly_exp_thousand_yen * 1000) * inflation_factor
+
+    # 住宅ローン返済額の年間支出 (円) - インフレ適用なし
+    monthly_loan_payment_yen = calculate_monthly_loan_payment(
         housing_loan["loan_amount"],
         housing_loan["loan_interest_rate"],
         housing_loan["loan_term_years"]
     )
-
-    for year in range(1, years_to_simulate + 1):
-        # 収入の上昇率をステップ年数ごとに考慮
-        # ただし、60歳/65歳時の収入が設定されている場合は、その設定が優先される
-        if not income_exp_changed_at_60 and not income_exp_changed_at_65:
-            if (year - 1) % income_growth_step_years == 0 and year > 1:
-                current_monthly_salary_main_yen *= (1 + income_growth_rate)
-                current_monthly_salary_sub_yen *= (1 + income_growth_rate) # 副収入も上昇率を適用
-                current_bonus_annual_yen *= (1 + income_growth_rate)
-
-        # メンバーの年齢に応じた収入・支出の変化
-        # 最初のメンバーの年齢をトリガーとする (簡略化のため)
-        # 複数のメンバーがいる場合、誰の年齢を基準にするか明確にする必要がある
-        # ここでは、family["members"]リストの最初のメンバーを基準とします。
-        if family["members"]:
-            first_member_name = family["members"][0]["name"]
-            first_member_age_in_year = member_current_ages_in_sim[first_member_name] # この年の開始時の年齢
-
-            if not income_exp_changed_at_60 and first_member_age_in_year >= 60:
-                # 60歳時の収入を適用 (0でない場合のみ)
-                if income_config["monthly_salary_main_at_60"] > 0:
-                    current_monthly_salary_main_yen = income_config["monthly_salary_main_at_60"] * 10000
-                if income_config["monthly_salary_sub_at_60"] > 0:
-                    current_monthly_salary_sub_yen = income_config["monthly_salary_sub_at_60"] * 10000
-                if income_config["bonus_annual_at_60"] > 0:
-                    current_bonus_annual_yen = income_config["bonus_annual_at_60"] * 10000
-                
-                # 60歳時の支出を適用 (0でない場合のみ)
-                for key_exp in ['housing', 'food', 'transportation', 'education', 'utilities', 'communication', 'leisure', 'medical', 'other']:
-                    if expenditure_config[f"{key_exp}_at_60"] > 0:
-                        current_expenditure_values_thousand_yen[key_exp] = expenditure_config[f"{key_exp}_at_60"]
-
-                income_exp_changed_at_60 = True
-
-            if not income_exp_changed_at_65 and first_member_age_in_year >= 65:
-                # 65歳時の収入を適用 (0でない場合のみ)
-                if income_config["monthly_salary_main_at_65"] > 0:
-                    current_monthly_salary_main_yen = income_config["monthly_salary_main_at_65"] * 10000
-                if income_config["monthly_salary_sub_at_65"] > 0:
-                    current_monthly_salary_sub_yen = income_config["monthly_salary_sub_at_65"] * 10000
-                if income_config["bonus_annual_at_65"] > 0:
-                    current_bonus_annual_yen = income_config["bonus_annual_at_65"] * 10000
-
-                # 65歳時の支出を適用 (0でない場合のみ)
-                for key_exp in ['housing', 'food', 'transportation', 'education', 'utilities', 'communication', 'leisure', 'medical', 'other']:
-                    if expenditure_config[f"{key_exp}_at_65"] > 0:
-                        current_expenditure_values_thousand_yen[key_exp] = expenditure_config[f"{key_exp}_at_65"]
-                
-                income_exp_changed_at_65 = True
-
-        # 満期保険の受取処理 (円) - 収入に加算
-        annual_insurance_payout_yen = 0
-        for policy in insurance_policies:
-            # 満期年数が設定されており、かつ現在の年が「支払い開始年 + 満期年数」と一致する場合
-            if policy["maturity_year"] > 0 and year == (policy["start_year"] + policy["maturity_year"]):
-                annual_insurance_payout_yen += policy["payout_amount"] * 10000 # 万円を円に
-
-        # 年間収入の計算 (円)
-        annual_income_yen = (current_monthly_salary_main_yen + current_monthly_salary_sub_yen) * 12 + current_bonus_annual_yen + annual_insurance_payout_yen
-
-        # 月額支出合計 (千円) - インフレ適用
-        # 住宅ローンがある場合、住宅費は加算しない
-        current_base_monthly_exp_thousand_yen = 0
-        for key_exp, value_exp in current_expenditure_values_thousand_yen.items():
-            # 住宅費であり、かつ住宅ローンがアクティブな場合は加算しない
-            if key_exp == 'housing' and housing_loan["loan_amount"] > 0 and \
-               housing_loan["start_year"] <= year and \
-               (year - housing_loan["start_year"] + 1) <= housing_loan["loan_term_years"]:
-                pass # 住宅ローンでカバーされるため、住宅費は加算しない
-            else:
-                current_base_monthly_exp_thousand_yen += value_exp
-
-        # 月額支出合計にのみインフレ率を適用し、年間支出に変換
-        inflated_base_annual_expenditure_yen = (current_base_monthly_exp_thousand_yen * 1000 * 12) * ((1 + inflation_rate)**(year - 1))
-        # シミュレーション結果表示用のインフレ適用後の月額支出
-        inflated_monthly_expenditure_for_display_yen = (current_base_monthly_exp_thousand_yen * 1000) * ((1 + inflation_rate)**(year - 1))
-
-
-        # 保険料の年間支出 (円) - インフレ適用なし
-        annual_insurance_premium_yen = 0
-        for policy in insurance_policies:
-            # 支払い開始年以降、かつ満期年数に達していない場合のみ支払い
-            if policy["start_year"] <= year and year < (policy["start_year"] + policy["maturity_year"]):
-                annual_insurance_premium_yen += policy["monthly_premium"] * 12
-
-        # 住宅ローン返済額の年間支出 (円) - インフレ適用なし
-        annual_housing_loan_payment_yen = 0
-        # ローン開始年以降、かつ返済期間内の場合のみ計上
-        if housing_loan["loan_amount"] > 0 and housing_loan["loan_term_years"] > 0 and housing_loan["start_year"] <= year and (year - housing_loan["start_year"] + 1) <= housing_loan["loan_term_years"]:
-            annual_housing_loan_payment_yen = monthly_loan_payment_yen_in_sim * 12 # ここで monthly_loan_payment_yen_in_sim を使用
-
-        # 学校一時金の年間支出 (円) - インフレ適用なし
-        annual_school_lump_sum_yen = 0
-        # 学校在学費用 (円) - インフレ適用なし
-        annual_school_enrollment_cost_yen = 0
-
-        for member_name, age_in_sim_start_of_year in member_current_ages_in_sim.items():
-            # その年の開始時の年齢
-            if age_in_sim_start_of_year > 0: # 年齢が設定されているメンバーのみ考慮
-                for school_type, school_info in school_lump_sums_config.items():
-                    # 一時金
-                    if school_info["start_age"] > 0 and age_in_sim_start_of_year == school_info["start_age"]:
-                        annual_school_lump_sum_yen += school_info["amount"] * 10000 # 万円を円に
-                    
-                    # 在学費用
-                    if school_info["start_age"] > 0 and school_info["duration"] > 0:
-                        # その年の開始時の年齢が学校の開始年齢以上で、かつ終了年齢以下の場合
-                        enrollment_end_age = school_info["start_age"] + school_info["duration"] - 1
-                        if school_info["start_age"] <= age_in_sim_start_of_year <= enrollment_end_age:
-                            annual_school_enrollment_cost_yen += school_info["annual_cost"] * 10000 # 万円を円に
-
-        # その他一時支出金 (円) - インフレ適用なし
-        annual_other_lump_expenditure_yen = 0
-        for lump_sum in other_lump_expenditures:
-            if lump_sum["year"] == year:
-                annual_other_lump_expenditure_yen += lump_sum["amount"] * 10000 # 万円を円に
-
-        # 合計年間支出 (インフレ適用は月額支出合計のみ)
-        current_annual_total_expenditure_yen = inflated_base_annual_expenditure_yen + annual_insurance_premium_yen + annual_housing_loan_payment_yen + annual_school_lump_sum_yen + annual_school_enrollment_cost_yen + annual_other_lump_expenditure_yen
-
-        # 年間収支 (円)
-        annual_balance_yen = annual_income_yen - current_annual_total_expenditure_yen
-
-        # 資産の変動 (投資利回り考慮) - 満期金は既に収入に加算されているため、ここでは加算しない
-        current_assets = current_assets * (1 + investment_return_rate) + annual_balance_yen
-
-        row_data = {
-            "年": year,
-            # メンバーの年齢は後で追加
-            "年間収入": int(annual_income_yen),
-            "年間支出": int(current_annual_total_expenditure_yen),
-            "年間収支": int(annual_balance_yen),
-            "年末資産": int(current_assets),
-            "月額支出合計（再掲）": int(inflated_monthly_expenditure_for_display_yen), # インフレ適用後の月額支出
-            "保険支出（再掲）": int(annual_insurance_premium_yen),
-            "住宅ローン額（再掲）": int(annual_housing_loan_payment_yen),
-            "学校一時金（再掲）": int(annual_school_lump_sum_yen),
-            "学校在学費用（再掲）": int(annual_school_enrollment_cost_yen),
-            "その他一時支出金（再掲）": int(annual_other_lump_expenditure_yen),
-            "保険満期金（再掲）": int(annual_insurance_payout_yen),
-        }
-
-        # 家族メンバーのその年の年齢を追加
-        member_age_data = {f"{name} 年齢": age for name, age in member_current_ages_in_sim.items()}
-        
-        # 指定された列順序
-        ordered_columns = [
-            "年",
-            # メンバーの年齢は動的に追加されるため、後で挿入
-            "年間収入",
-            "年間支出",
-            "年間収支",
-            "年末資産",
-            "月額支出合計（再掲）",
-            "保険支出（再掲）",
-            "住宅ローン額（再掲）",
-            "学校一時金（再掲）",
-            "学校在学費用（再掲）",
-            "その他一時支出金（再掲）",
-            "保険満期金（再掲）",
-        ]
-
-        # メンバー年齢の列を正しい位置に挿入
-        final_ordered_row_data = {}
-        for col in ordered_columns:
-            if col == "年間収入": # 「年間収入」の直前にメンバー年齢を挿入
-                for member_name in sorted(member_current_ages_in_sim.keys()):
-                    final_ordered_row_data[f"{member_name} 年齢"] = member_age_data[f"{member_name} 年齢"]
-            final_ordered_row_data[col] = row_data[col]
-        
-        results.append(final_ordered_row_data)
-
-        # 家族メンバーの年齢を更新 (次の年のために)
-        for name in member_current_ages_in_sim:
-            member_current_ages_in_sim[name] += 1
-
-    return pd.DataFrame(results)
+    annual_housing_loan_payment_yen = np.where(loan_active, monthly_loan_payment_yen * 12, 0)
+
+    # 学校一時金・学校在学費用の年間支出 (円) - インフレ適用なし
+    # 開始年齢が設定されている学校のみを並列配列に変換し、(年数 × メンバー数 × 学校数) でまとめて判定する
+    schools = [school_info for school_info in school_lump_sums_config.values() if school_info["start_age"] > 0]
+    school_start_ages = np.array([school_info["start_age"] for school_info in schools], dtype=np.int64)
+    school_end_ages = np.array([school_info["start_age"] + school_info["duration"] - 1 for school_info in schools], dtype=np.int64)
+    school_amounts_yen = np.array([school_info["amount"] * 10000 for school_info in schools], dtype=np.int64) # 万円を円に
+    school_annual_costs_yen = np.array([school_info["annual_cost"] * 10000 for school_info in schools], dtype=np.int64) # 万円を円に
+
+    # 一時金: メンバーと学校の組ごとに、開始年齢に到達する年 (開始年齢 - 初期年齢 + 1) に計上する
+    # (学校の開始年齢は正のため、年齢0以下のメンバーは自然に除外される)
+    initial_ages = np.array(list(member_initial_ages.values()), dtype=np.int64)
+    hit_years = (school_start_ages - initial_ages[:, np.newaxis] + 1).ravel()
+    hit_amounts_yen = np.broadcast_to(school_amounts_yen, (len(initial_ages), len(schools))).ravel()
+    in_range = (hit_years >= 1) & (hit_years <= years_to_simulate)
+    annual_school_lump_sum_yen = np.bincount(hit_years[in_range], weights=hit_amounts_yen[in_range], minlength=years_to_simulate + 1)[1:]
+
+    # その年の開始時の各メンバーの年齢
+    member_ages = (initial_ages + years_col - 1)[:, :, np.newaxis]
+    # 在学費用 (在学期間が0以下の学校は終了年齢が開始年齢より前になるため計上されない)
+    enrolled = (school_start_ages <= member_ages) & (member_ages <= school_end_ages)
+    annual_school_enrollment_cost_yen = (enrolled * school_annual_costs_yen).sum(axis=(1, 2))
+
+    # その他一時支出金 (円) - インフレ適用なし
+    lump_years = np.array([lump_sum["year"] for lump_sum in other_lump_expenditures], dtype=np.int64)
+    lump_amounts_yen = np.array([lump_sum["amount"] * 10000 for lump_sum in other_lump_expenditures], dtype=np.int64) # 万円を円に
+    annual_other_lump_expenditure_yen = ((years_col == lump_years) * lump_amounts_yen).sum(axis=1)
+
+    # 合計年間支出 (インフレ適用は月額支出合計のみ)
+    annual_total_expenditure_yen = inflated_base_annual_expenditure_yen + annual_insurance_premium_yen + annual_housing_loan_payment_yen + annual_school_lump_sum_yen + annual_school_enrollment_cost_yen + annual_other_lump_expenditure_yen
+
+    # 年間収支 (円)
+    annual_balance_yen = annual_income_yen - annual_total_expenditure_yen
+
+    # 資産の変動 (投資利回り考慮) - 満期金は既に収入に加算されているため、ここでは加算しない
+    # assets[t] = assets[t-1] * g + balance[t] (g = 1 + 利回り) を閉形式で解く:
+    # assets[t] = g^t * (initial_assets + Σ_{k<=t} balance[k] / g^k)
+    growth = np.cumprod(np.full(years_to_simulate, 1 + investment_return_rate))
+    year_end_assets_yen = growth * (initial_assets + np.cumsum(annual_balance_yen / growth))
+
+    # 指定された列順序 (メンバー年齢は「年」と「年間収入」の間に名前順で挿入)
+    columns = {"年": years}
+    age_cols = []
+    for member_name in sorted(member_initial_ages):
+        columns[f"{member_name} 年齢"] = member_initial_ages[member_name] + years - 1
+        age_cols.append(f"{member_name} 年齢")
+    columns.update({
+        "年間収入": annual_income_yen.astype(np.int64, copy=False),
+        "年間支出": annual_total_expenditure_yen.astype(np.int64, copy=False),
+        "年間収支": annual_balance_yen.astype(np.int64, copy=False),
+        "年末資産": year_end_assets_yen.astype(np.int64, copy=False),
+        "月額支出合計（再掲）": inflated_monthly_expenditure_for_display_yen.astype(np.int64, copy=False), # インフレ適用後の月額支出
+        "保険支出（再掲）": annual_insurance_premium_yen.astype(np.int64, copy=False),
+        "住宅ローン額（再掲）": annual_housing_loan_payment_yen.astype(np.int64, copy=False),
+        "学校一時金（再掲）": annual_school_lump_sum_yen.astype(np.int64, copy=False),
+        "学校在学費用（再掲）": annual_school_enrollment_cost_yen.astype(np.int64, copy=False),
+        "その他一時支出金（再掲）": annual_other_lump_expenditure_yen.astype(np.int64, copy=False),
+        "保険満期金（再掲）": annual_insurance_payout_yen.astype(np.int64, copy=False),
+    })
+
+    # 全列が型の決まったNumPy配列なので、コピーせずにそのままDataFrameの列として使う
+    simulation_df = pd.DataFrame(columns, copy=False)
+    # 年齢列の名前を保持しておき、表示側で列名の文字列検索をしなくて済むようにする
+    simulation_df.attrs["age_cols"] = age_cols
+    return simulation_df
 
 # --- Gemini API 呼び出し（シミュレーション） ---
 async def get_gemini_suggestion(user_plan_description, simulation_df, current_data):
     """
     Gemini API を呼び出してライフプランの改善点を取得します。
+    応答はストリーミングを想定し、生成された部分から順に返す非同期ジェネレータです。
     ここではシミュレーションとして、シミュレーション結果を反映した応答を返します。
     """
     # 実際のAPI呼び出しは、requestsライブラリなどを使用し、
@@ -371,9 +372,10 @@ async def get_gemini_suggestion(user_plan_description, simulation_df, current_da
     suggestion_output = f"## ライフプラン改善提案 (Gemini AIによる)\n\n"
     suggestion_output += f"現在のシミュレーションでは、**{years_to_simulate}年後の年末資産は {final_assets:,} 円** と予測されています。\n"
     suggestion_output += f"年間平均収支は {int(average_annual_balance):,} 円です。\n\n"
+    yield suggestion_output
 
     if final_assets < 0:
-        suggestion_output += """
+        yield """
         ### 🚨 資産がマイナスに転じる可能性があります！緊急の見直しが必要です。
 
         * **支出の大幅な削減:** 特に住居費、食費、娯楽費など、大きな割合を占める支出から見直し、可能な限り削減目標を設定しましょう。
@@ -381,7 +383,7 @@ async def get_gemini_suggestion(user_plan_description, simulation_df, current_da
         * **資産の早期取り崩し検討:** 必要であれば、初期資産の一部を計画的に取り崩すことも視野に入れる必要があります。
         """
     elif final_assets < 30000000: # 例: 3000万円を目標値の目安とする
-        suggestion_output += """
+        yield """
         ### ⚠️ 資産形成の加速が必要です。
 
         * **貯蓄率の向上:**
@@ -393,7 +395,7 @@ async def get_gemini_suggestion(user_plan_description, simulation_df, current_da
         * **臨時収入の活用:** ボーナスや臨時収入は、積極的に貯蓄や投資に回すことを検討してください。
         """
     else:
-        suggestion_output += """
+        yield """
         ### ✅ 素晴らしいライフプランです！さらなる最適化を目指しましょう。
 
         * **資産運用の多様化:**
@@ -405,9 +407,119 @@ async def get_gemini_suggestion(user_plan_description, simulation_df, current_da
             * インフレが資産価値に与える影響を考慮し、インフレに強い資産への投資も検討しましょう。
         """
 
-    suggestion_output += "\n\n" + prompt_text # AIが受け取ったプロンプトも参考として表示
+    yield "\n\n" + prompt_text # AIが受け取ったプロンプトも参考として表示
+
+@st.cache_resource
+def get_event_loop():
+    """
+    AI呼び出し用のイベントループを返します。
+    ループは専用のスレッドで動かし続け、再実行やクリックのたびに作り直さないようにします。
+    """
+    loop = asyncio.new_event_loop()
+    threading.Thread(target=loop.run_forever, daemon=True).start()
+    return loop
+
+# AIの応答の各部分を待つ最大秒数 (応答が止まった場合にスクリプトが待ち続けないようにする)
+AI_CHUNK_TIMEOUT_SECONDS = 60
 
-    return suggestion_output
+def iterate_in_event_loop(async_iterator, timeout=AI_CHUNK_TIMEOUT_SECONDS):
+    """
+    非同期ジェネレータを、常駐のイベントループ上で1要素ずつ進める同期ジェネレータに変換します。
+    各要素を timeout 秒以内に受け取れない場合は TimeoutError を送出します。
+    途中で打ち切られた場合も、非同期ジェネレータはイベントループ上で閉じられます。
+    """
+    loop = get_event_loop()
+
+    async def next_chunk():
+        try:
+            return await async_iterator.__anext__()
+        except StopAsyncIteration:
+            return None
+
+    async def close_iterator():
+        await async_iterator.aclose()
+
+    try:
+        while True:
+            future = asyncio.run_coroutine_threadsafe(next_chunk(), loop)
+            try:
+                chunk = future.result(timeout=timeout)
+            except concurrent.futures.TimeoutError:
+                future.cancel() # 待ちきれなかった呼び出しはイベントループ上で取り消す
+                raise TimeoutError(f"AIの応答が{timeout}秒以内に返りませんでした。")
+            if chunk is None:
+                return
+            yield chunk
+    finally:
+        # 再実行などでストリームが途中で破棄された場合も、非同期ジェネレータを閉じておく
+        asyncio.run_coroutine_threadsafe(close_iterator(), loop)
+
+SUGGESTION_CACHE_MAX_ENTRIES = 32
+SUGGESTION_CACHE_TTL_SECONDS = 3600
+
+class SuggestionCache:
+    """
+    AIによる改善提案のキャッシュ (説明文, シミュレーション結果のハッシュ, 入力データのハッシュ) -> 提案全文。
+    全セッションで共有されるため読み書きはロックで保護し、有効期限は提案ごとに判定します。
+    """
+    def __init__(self, max_entries, ttl_seconds):
+        self._entries = collections.OrderedDict() # キー -> (保存時刻, 提案全文)
+        self._lock = threading.Lock()
+        self._max_entries = max_entries
+        self._ttl_seconds = ttl_seconds
+
+    def get(self, key):
+        with self._lock:
+            entry = self._entries.get(key)
+            if entry is None:
+                return None
+            stored_at, suggestion = entry
+            if time.monotonic() - stored_at > self._ttl_seconds:
+                del self._entries[key] # 期限切れの提案は捨てる
+                return None
+            return suggestion
+
+    def put(self, key, suggestion):
+        with self._lock:
+            self._entries[key] = (time.monotonic(), suggestion)
+            self._entries.move_to_end(key)
+            while len(self._entries) > self._max_entries:
+                self._entries.popitem(last=False) # 最も古い提案を捨てる
+
+@st.cache_resource
+def get_suggestion_cache():
+    return SuggestionCache(SUGGESTION_CACHE_MAX_ENTRIES, SUGGESTION_CACHE_TTL_SECONDS)
+
+# AIによる改善提案で参照するシミュレーション結果の列
+SUGGESTION_COLUMNS = ["年間収入", "年間支出", "年間収支", "年末資産"]
+
+def make_suggestion_key(user_plan_description, simulation_df, current_data):
+    """AIによる改善提案を識別するキー (説明文, シミュレーション結果のハッシュ, 入力データのハッシュ) を返します。"""
+    return (user_plan_description, hash_simulation_df(simulation_df[SUGGESTION_COLUMNS]), hash_data(current_data))
+
+def request_suggestion(user_plan_description, simulation_df, current_data, cache_key=None):
+    """
+    AIによる改善提案を、生成された部分から順に返すジェネレータです (st.write_stream 用)。
+    説明文・シミュレーション結果・入力データが同じ場合は、キャッシュ済みの提案をまとめて返します。
+    呼び出し側で make_suggestion_key を計算済みの場合は cache_key に渡すと、ハッシュの再計算を省きます。
+    """
+    if cache_key is None:
+        cache_key = make_suggestion_key(user_plan_description, simulation_df, current_data)
+    # 提案に使う列だけに絞ってから、AI関数に渡す
+    simulation_df = simulation_df[SUGGESTION_COLUMNS]
+
+    suggestion_cache = get_suggestion_cache()
+    cached_suggestion = suggestion_cache.get(cache_key)
+    if cached_suggestion is not None:
+        yield cached_suggestion
+        return
+
+    chunks = []
+    for chunk in iterate_in_event_loop(get_gemini_suggestion(user_plan_description, simulation_df, current_data)):
+        chunks.append(chunk)
+        yield chunk
+
+    suggestion_cache.put(cache_key, "".join(chunks))
 
 # --- Q&Aデータ ---
 qa_data = [
@@ -511,23 +623,110 @@ DYNAMIC_LIST_ITEM_TYPE_MAP = {
     "year": int,   # (other_lump_expenditures用)
 }
 
+# 動的なリストに要素を追加するときのデフォルトの辞書 (キーはリスト名)
+LIST_ITEM_DEFAULTS = {
+    "members": {"name": "", "initial_age": 0},
+    "insurance_policies": {"name": "", "monthly_premium": 0, "maturity_year": 0, "payout_amount": 0, "start_year": 1},
+    "other_lump_expenditures": {"name": "", "amount": 0, "year": 0},
+}
+
+# 動的なリストの項目パス ("family.members.0.initial_age" など) を1回の照合で判定する正規表現
+DYNAMIC_LIST_PATH_RE = re.compile(
+    r"^(family\.members|insurance_policies|other_lump_expenditures)\.(\d+)\.("
+    + "|".join(map(re.escape, DYNAMIC_LIST_ITEM_TYPE_MAP))
+    + r")$"
+)
+
+# --- CSVの値を期待される型に変換するヘルパー関数 ---
+def convert_csv_value(value_from_csv, item_path_str, target_type):
+    try:
+        if pd.isna(value_from_csv):
+            return 0 if target_type == int else 0.0
+        return target_type(value_from_csv)
+    except (ValueError, TypeError):
+        st.warning(f"Warning: Could not convert '{value_from_csv}' for '{item_path_str}' to {target_type.__name__}. Using default value (0 or 0.0).")
+        return 0 if target_type == int else 0.0
+
+# --- TYPE_MAPの固定パスごとに、値を型変換してネストされた辞書に設定するセッターを生成 ---
+# CSV読み込み時にパス文字列の分割や階層ごとの判定をせず、辞書の参照1回で設定先が決まるようにする
+def make_path_setter(item_path_str, target_type):
+    *parent_keys, last_key = item_path_str.split('.')
+
+    def path_setter(data, value_from_csv):
+        current_level = data
+        for key_part in parent_keys:
+            if not isinstance(current_level.get(key_part), (dict, list)):
+                current_level[key_part] = {}
+            current_level = current_level[key_part]
+        current_level[last_key] = convert_csv_value(value_from_csv, item_path_str, target_type)
+
+    return path_setter
+
+PATH_SETTERS = {path: make_path_setter(path, target_type) for path, target_type in TYPE_MAP.items()}
+
 # --- データをフラット化してCSV用に変換するヘルパー関数 ---
 def flatten_data_for_csv(data_dict, parent_key=''):
-    flattened = []
-    for key, value in data_dict.items():
-        new_key = f"{parent_key}.{key}" if parent_key else key
-        if isinstance(value, dict):
-            flattened.extend(flatten_data_for_csv(value, new_key))
-        elif isinstance(value, list):
-            for i, item in enumerate(value):
-                if isinstance(item, dict):
-                    # リスト内の辞書の場合、キーは "parent.list_name.index.dict_key"
-                    flattened.extend(flatten_data_for_csv(item, f"{new_key}.{i}"))
-                else: # リスト内に辞書以外の要素がある場合 (現在のデータ構造では発生しないはずだが念のため)
-                    flattened.append({"項目": f"{new_key}.{i}", "値": item})
+    """
+    ネストされた辞書を "親.子.インデックス.キー" 形式の項目名と値の2つのリストに展開します。
+    再帰とリストの連結を避け、明示的なスタックで元の順序どおりに走査します。
+    """
+    keys = []
+    values = []
+    # (項目名, 要素, リストの要素かどうか) を積み、子要素は逆順に積んで元の順序で取り出す
+    stack = [(parent_key, data_dict, False)]
+    while stack:
+        key, node, in_list = stack.pop()
+        if isinstance(node, dict):
+            stack.extend(
+                (f"{key}.{child_key}" if key else child_key, value, False)
+                for child_key, value in reversed(node.items())
+            )
+        elif isinstance(node, list) and not in_list:
+            # リスト内の辞書の場合、キーは "parent.list_name.index.dict_key"
+            stack.extend((f"{key}.{i}", item, True) for i, item in reversed(list(enumerate(node))))
         else:
-            flattened.append({"項目": new_key, "値": value})
-    return flattened
+            keys.append(key)
+            values.append(node)
+    return keys, values
+
+# ライフプランデータのCSVの列 (項目パス, 値)
+CSV_ITEM_COLUMN = "項目"
+CSV_VALUE_COLUMN = "値"
+CSV_HEADER = (CSV_ITEM_COLUMN, CSV_VALUE_COLUMN)
+
+# --- ライフプランデータをダウンロード用のCSVバイト列に変換するヘルパー関数 ---
+@st.cache_data(max_entries=4, show_spinner=False)
+def serialize_plan_to_csv(data_json, compress=False):
+    """
+    JSON文字列に固定したライフプランデータを、CSV (UTF-8) のバイト列に変換します。
+    compress=True の場合はgzip (圧縮レベル1) で圧縮したバイト列を返します。
+    CSVの項目順を保つため、data_json はキーを並べ替えずに json.dumps したものを渡します。
+    同じデータに対する変換結果はキャッシュされます。
+    """
+    csv_keys, csv_values = flatten_data_for_csv(json.loads(data_json))
+    # 2列の単純な表なので、DataFrameを介さずcsvモジュールで直接書き出す (改行はpandasと同じLF)
+    buffer = io.StringIO()
+    writer = csv.writer(buffer, lineterminator="\n")
+    writer.writerow(CSV_HEADER)
+    writer.writerows(zip(csv_keys, csv_values))
+    csv_bytes = buffer.getvalue().encode('utf-8')
+    if compress:
+        # 項目名の繰り返しが多く、圧縮レベル1でも十分に小さくなる
+        return gzip.compress(csv_bytes, compresslevel=1, mtime=0)
+    return csv_bytes
+
+# --- ライフプランデータを分析用のParquetバイト列に変換するヘルパー関数 ---
+@st.cache_data(max_entries=4, show_spinner=False)
+def serialize_plan_to_parquet(data_json):
+    csv_keys, csv_values = flatten_data_for_csv(json.loads(data_json))
+    # Parquetの列は型を揃える必要があるため、値はCSVと同じ文字列表現で保存する
+    df_plan = pd.DataFrame({
+        CSV_ITEM_COLUMN: csv_keys,
+        CSV_VALUE_COLUMN: ["" if value is None else str(value) for value in csv_values],
+    })
+    buffer = io.BytesIO()
+    df_plan.to_parquet(buffer, index=False, compression="zstd", compression_level=1)
+    return buffer.getvalue()
 
 # --- CSVからデータを読み込み、ネストされた辞書に変換するヘルパー関数 ---
 def unflatten_data_from_csv(df_uploaded, initial_data_structure):
@@ -539,9 +738,32 @@ def unflatten_data_from_csv(df_uploaded, initial_data_structure):
     new_data["insurance_policies"] = []
     new_data["other_lump_expenditures"] = []
 
-    for index, row in df_uploaded.iterrows():
-        item_path_str = str(row["項目"]) # Ensure item_path_str is always a string
-        value_from_csv = row["値"]
+    # iterrowsは行ごとにSeriesを生成するため、列を配列として取り出してzipで走査する
+    for item_path_str, value_from_csv in zip(df_uploaded[CSV_ITEM_COLUMN].to_numpy(), df_uploaded[CSV_VALUE_COLUMN].to_numpy()):
+        item_path_str = str(item_path_str) # Ensure item_path_str is always a string
+
+        # TYPE_MAPに定義された固定パスは、事前に生成したセッターで直接設定する
+        path_setter = PATH_SETTERS.get(item_path_str)
+        if path_setter is not None:
+            path_setter(new_data, value_from_csv)
+            continue
+
+        # 動的なリストの項目は、リストを必要な長さまで伸ばして型変換した値を直接設定する
+        dynamic_match = DYNAMIC_LIST_PATH_RE.match(item_path_str)
+        if dynamic_match:
+            list_path, idx_str, field = dynamic_match.groups()
+            *parent_keys, list_key = list_path.split('.')
+            container = new_data
+            for key_part in parent_keys:
+                container = container.get(key_part) if isinstance(container, dict) else None
+            target_list = container.get(list_key) if isinstance(container, dict) else None
+            if isinstance(target_list, list):
+                idx = int(idx_str)
+                while len(target_list) <= idx:
+                    target_list.append(dict(LIST_ITEM_DEFAULTS[list_key]))
+                if isinstance(target_list[idx], dict):
+                    target_list[idx][field] = convert_csv_value(value_from_csv, item_path_str, DYNAMIC_LIST_ITEM_TYPE_MAP[field])
+                    continue
 
         path_parts = item_path_str.split('.')
         current_level = new_data
@@ -561,14 +783,7 @@ def unflatten_data_from_csv(df_uploaded, initial_data_structure):
 
                 # Perform type conversion
                 if target_type:
-                    try:
-                        if pd.isna(processed_value):
-                            processed_value = 0 if target_type == int else 0.0
-                        else:
-                            processed_value = target_type(processed_value)
-                    except (ValueError, TypeError):
-                        st.warning(f"Warning: Could not convert '{value_from_csv}' for '{item_path_str}' to {target_type.__name__}. Using default value (0 or 0.0).")
-                        processed_value = 0 if target_type == int else 0.0
+                    processed_value = convert_csv_value(value_from_csv, item_path_str, target_type)
                 else: # Fallback for types not in TYPE_MAP or DYNAMIC_LIST_ITEM_TYPE_MAP
                     if pd.isna(processed_value):
                         processed_value = "" # Default for strings
@@ -600,14 +815,8 @@ def unflatten_data_from_csv(df_uploaded, initial_data_structure):
                     # リストに十分な要素があることを確認し、必要に応じてデフォルトの辞書を追加
                     while len(current_level) <= idx:
                         parent_key_for_list = path_parts[i-1] if i > 0 else None
-                        if parent_key_for_list == "members":
-                            current_level.append({"name": "", "initial_age": 0})
-                        elif parent_key_for_list == "insurance_policies":
-                            current_level.append({"name": "", "monthly_premium": 0, "maturity_year": 0, "payout_amount": 0, "start_year": 1})
-                        elif parent_key_for_list == "other_lump_expenditures":
-                            current_level.append({"name": "", "amount": 0, "year": 0})
-                        else:
-                            current_level.append({}) # Generic dict if type unknown
+                        # 種類が不明なリストには空の辞書を追加する
+                        current_level.append(dict(LIST_ITEM_DEFAULTS.get(parent_key_for_list, {})))
                     current_level = current_level[idx] # 次のレベル（リスト内の辞書）に進む
                 else: # 辞書のキーの場合
                     next_is_list = (i + 1 < len(path_parts) and path_parts[i+1].isdigit())
@@ -621,6 +830,18 @@ def unflatten_data_from_csv(df_uploaded, initial_data_structure):
                     current_level = current_level[key_part]
     return new_data
 
+# --- アップロードされたCSVを読み込むヘルパー関数 ---
+@st.cache_data(show_spinner=False)
+def parse_uploaded_csv(file_bytes):
+    """
+    アップロードされたCSVのバイト列を読み込み、(CSVのDataFrame, ライフプランデータ) を返します。
+    同じファイルに対する再実行時の読み込みはキャッシュされます。
+    """
+    # gzip圧縮されたCSV (.csv.gz) は先頭のマジックナンバーで判定して展開する
+    compression = "gzip" if file_bytes[:2] == b"\x1f\x8b" else None
+    df_uploaded = pd.read_csv(io.BytesIO(file_bytes), compression=compression, engine="pyarrow")
+    return df_uploaded, unflatten_data_from_csv(df_uploaded, get_initial_data())
+
 # --- DataFrameのスタイル設定ヘルパー関数 ---
 def apply_rekei_style(s):
     # '再掲'列の文字色を灰色にする
@@ -638,6 +859,179 @@ def apply_65_age_style(val):
     color = 'color: blue' if isinstance(val, (int, float)) and val == 65 else ''
     return color
 
+# 金額の列 (円)
+MONEY_COLUMNS = [
+    "年間収入", "年間支出", "年間収支", "年末資産",
+    "月額支出合計（再掲）", "保険支出（再掲）", "住宅ローン額（再掲）", "学校一時金（再掲）",
+    "学校在学費用（再掲）", "その他一時支出金（再掲）", "保険満期金（再掲）",
+]
+
+# 金額の表示形式はStylerのformatではなくcolumn_configで指定し、フロントエンド側で整形させる
+# (メンバー年齢の列は自動的に表示されるため、ここでは特別なフォーマットは不要)
+SIMULATION_COLUMN_CONFIG = {column: st.column_config.NumberColumn(format="%,d円") for column in MONEY_COLUMNS}
+
+# 結果の表で最初に表示する年数 (これより長い期間の表は、全期間表示に切り替えたときにだけ描画する)
+SIMULATION_PREVIEW_ROWS = 30
+
+# Stylerは描画時に内部状態が書き換えられるため、セッション間で共有せず描画のたびに作り直す
+# (表示する行数は SIMULATION_PREVIEW_ROWS までに抑えているので、作り直しても軽い)
+def build_styled_simulation_df(simulation_df):
+    styled_df = simulation_df.style
+
+    # 再掲列の文字色
+    styled_df = styled_df.apply(apply_rekei_style, axis=0) # axis=0 で列全体に適用
+
+    # 年間収支がマイナスのセルの文字色
+    styled_df = styled_df.map(apply_negative_balance_style, subset=['年間収支'])
+
+    # メンバーの年齢が65歳の場合のセルの文字色
+    member_age_cols = simulation_df.attrs.get("age_cols", [])
+    if member_age_cols: # メンバー年齢列が存在する場合のみ適用
+        styled_df = styled_df.map(apply_65_age_style, subset=member_age_cols)
+    return styled_df
+
+
+# --- 家族メンバー・保険・その他一時支出金の追加・削除 (ボタンのコールバック) ---
+# コールバックはスクリプトの再実行前に呼ばれるため、st.rerun() による二重の再実行が不要になる
+def add_member():
+    st.session_state.data["family"]["members"].append({"name": f"New Member {st.session_state.members_count + 1}", "initial_age": 0})
+    st.session_state.members_count += 1
+
+def remove_last_member():
+    st.session_state.data["family"]["members"].pop()
+    st.session_state.members_count -= 1
+
+# 保険の入力欄のキーの接頭辞と、対応する保険データの項目
+INSURANCE_WIDGET_FIELDS = {
+    "ins_name": "name",
+    "ins_premium": "monthly_premium",
+    "ins_maturity_year": "maturity_year",
+    "ins_payout": "payout_amount",
+    "ins_start_year": "start_year",
+}
+
+def seed_insurance_widget_state(i, policy, overwrite=False):
+    """
+    保険 i の入力欄の状態を保険データから設定します。
+    入力欄は value= を渡さずキーの状態だけで値を持つため、状態がまだない場合 (または overwrite=True の場合) にだけ設定します。
+    """
+    for widget_prefix, field in INSURANCE_WIDGET_FIELDS.items():
+        widget_key = f"{widget_prefix}_{i}"
+        if overwrite or widget_key not in st.session_state:
+            st.session_state[widget_key] = policy[field]
+
+def add_insurance_policy():
+    st.session_state.data["insurance_policies"].append({"name": f"新規保険 {st.session_state.insurance_count + 1}", "monthly_premium": 0, "maturity_year": 0, "payout_amount": 0, "start_year": 1})
+    st.session_state.insurance_count += 1
+
+def remove_last_insurance_policy():
+    st.session_state.data["insurance_policies"].pop()
+    st.session_state.insurance_count -= 1
+
+def add_other_lump_expenditure():
+    st.session_state.data["other_lump_expenditures"].append({"name": f"新規一時支出 {st.session_state.other_lump_expenditures_count + 1}", "amount": 0, "year": 0})
+    st.session_state.other_lump_expenditures_count += 1
+
+def remove_last_other_lump_expenditure():
+    st.session_state.data["other_lump_expenditures"].pop()
+    st.session_state.other_lump_expenditures_count -= 1
+
+
+# --- シミュレーション結果の表示 ---
+# フラグメントにすることで、結果表示の部分だけを単独で再実行できるようにする
+@st.fragment
+def render_simulation_results(simulation_df):
+    # 長期間の結果は先頭の年だけを表示し、全期間の表は必要なときにだけ描画する
+    # スタイル適用
+    if len(simulation_df) <= SIMULATION_PREVIEW_ROWS:
+        st.dataframe(build_styled_simulation_df(simulation_df), use_container_width=True, column_config=SIMULATION_COLUMN_CONFIG)
+    else:
+        st.dataframe(build_styled_simulation_df(simulation_df.head(SIMULATION_PREVIEW_ROWS)), use_container_width=True, column_config=SIMULATION_COLUMN_CONFIG)
+        # トグルはフラグメント内にあるため、切り替えても結果表示の部分だけが再実行される
+        if st.toggle(f"全期間 ({len(simulation_df)}年) の表を表示"):
+            st.dataframe(build_styled_simulation_df(simulation_df), use_container_width=True, column_config=SIMULATION_COLUMN_CONFIG)
+
+    # 年末資産がマイナスの年を1回の比較で求め、グラフの色とマイナス年の表示の両方に使う
+    years = simulation_df['年'].to_numpy()
+    year_end_assets = simulation_df['年末資産'].to_numpy()
+    negative_mask = year_end_assets < 0
+    has_negative_assets = bool(negative_mask.any())
+
+    # グラフの線の色を条件付きで変更
+    line_chart_color_hex = "#1f77b4" # デフォルトの青色 (Streamlitのデフォルトに合わせる)
+    if has_negative_assets:
+        line_chart_color_hex = "#ff0000" # 赤字になったら赤色にする
+
+    # Streamlitのline_chartのcolor引数は、単一のSeriesの場合でもリストで渡すのが安全
+    # グラフ用の年末資産の系列は、取り出し済みの配列から年をインデックスとして直接作る
+    asset_chart_data = pd.Series(year_end_assets, index=pd.Index(years, name="年"), name="年末資産", copy=False)
+    st.line_chart(asset_chart_data, color=[line_chart_color_hex])
+
+    # マイナスになる年数と最大マイナス額の表示
+    if has_negative_assets:
+        first_negative_year = int(years[negative_mask.argmax()])
+        max_negative_amount = int(year_end_assets[negative_mask].min())
+        st.error(f"**資産がマイナスになる年数:** {first_negative_year}年目")
+        st.error(f"**最大マイナス額:** {max_negative_amount:,}円")
+    else:
+        st.success("**シミュレーション期間中、資産がマイナスになることはありませんでした。**")
+        st.markdown(f"**最終的な年末資産:** {st.session_state.final_assets:,}円")
+
+
+# --- ダウンロードボタン ---
+# フラグメントにすることで、ダウンロードボタンの操作ではこの部分だけが再実行される
+@st.fragment
+def render_download_button():
+    # CSVへの変換はボタンが押されたときにだけ行う (コールバックは別スレッドで実行されるため、
+    # 現在のデータをこの時点でJSON文字列に固定して渡す)
+    data_json = json.dumps(st.session_state.data, ensure_ascii=False)
+    st.download_button(
+        label="現在のライフプランデータをダウンロード (CSV, gzip圧縮)",
+        data=lambda: serialize_plan_to_csv(data_json, compress=True),
+        file_name="life_plan_data.csv.gz",
+        mime="application/gzip",
+    )
+    with st.expander("詳細オプション"):
+        st.download_button(
+            label="Parquet形式でダウンロード (pandas・pyarrowでの分析用)",
+            data=lambda: serialize_plan_to_parquet(data_json),
+            file_name="life_plan_data.parquet",
+            mime="application/octet-stream",
+        )
+
+
+# --- AIによる改善提案 ---
+# フラグメントにすることで、説明文の編集や質問ボタンの操作ではこの部分だけが再実行され、
+# 入力フォームや結果の表・グラフは再描画されない
+@st.fragment
+def render_ai_section():
+    user_plan_description = st.text_area(
+        "あなたのライフプランについて、目標や課題、現在の状況などを具体的に教えてください。",
+        value="現在の収入と支出で、20年後に老後資金として5,000万円を貯蓄したいと考えています。何か改善できる点はありますか？",
+        height=150
+    )
+
+    if st.button("AIに改善点を尋ねる"):
+        simulation_df = st.session_state.get("simulation_df")
+        if user_plan_description and simulation_df is not None and not simulation_df.empty:
+            suggestion_key = make_suggestion_key(user_plan_description, simulation_df, st.session_state.data)
+            if st.session_state.get("last_ai_key") == suggestion_key and "last_ai_suggestion" in st.session_state:
+                # 前回と同じ内容での再クリックは、直前の提案をそのまま表示する
+                st.markdown(st.session_state.last_ai_suggestion)
+            else:
+                try:
+                    with st.spinner("AIが改善点を考えています..."):
+                        # シミュレーション結果と現在のデータをAI関数に渡す
+                        # 提案は生成された部分から順に表示する
+                        suggestion = st.write_stream(request_suggestion(user_plan_description, simulation_df, st.session_state.data, cache_key=suggestion_key))
+                except TimeoutError as e:
+                    st.error(f"AIによる改善提案を取得できませんでした。時間をおいて再度お試しください。エラー: {e}")
+                else:
+                    st.session_state.last_ai_key = suggestion_key
+                    st.session_state.last_ai_suggestion = suggestion
+        else:
+            st.warning("ライフプランの説明を入力し、「シミュレーションを実行」してからAIに尋ねてください。")
+
 
 # --- Streamlit アプリケーションの構築 ---
 def main():
@@ -658,16 +1052,21 @@ def main():
     st.header("1. データ管理")
     st.markdown("現在のライフプランデータをアップロードまたはダウンロードできます。")
 
-    uploaded_file = st.file_uploader("CSVファイルをアップロード", type=["csv"])
+    uploaded_file = st.file_uploader("CSVファイルをアップロード", type=["csv", "gz"])
     if uploaded_file is not None:
         try:
-            df_uploaded = pd.read_csv(uploaded_file)
+            df_uploaded, uploaded_data = parse_uploaded_csv(uploaded_file.getvalue())
             
             # Store the uploaded DataFrame for viewing later
-            st.session_state.uploaded_csv_df = df_uploaded.copy()
+            st.session_state.uploaded_csv_df = df_uploaded
 
             # バージョン管理は行わず、常にデータを読み込む
-            st.session_state.data = unflatten_data_from_csv(df_uploaded, get_initial_data())
+            st.session_state.data = uploaded_data
+            # 新しいファイルが読み込まれたときは、保険の入力欄の状態もファイルの内容で置き換える
+            if st.session_state.get("uploaded_file_id") != uploaded_file.file_id:
+                for i, policy in enumerate(uploaded_data["insurance_policies"]):
+                    seed_insurance_widget_state(i, policy, overwrite=True)
+                st.session_state.uploaded_file_id = uploaded_file.file_id
             st.success("データが正常にアップロードされ、反映されました！")
             # st.warning("アップロードされたCSVの項目が現在のアプリのバージョンと異なる場合、正しく読み込めない可能性があります。") # 削除
             st.info("データ内容を確認できます。") # 変更
@@ -693,261 +1092,257 @@ def main():
     st.header("2. ライフプラン設定")
     st.markdown("標準的な値を参考に、ご自身のライフプランに合わせて数値を調整してください。")
 
-    col1, col2, col3 = st.columns(3)
-    col4, col5 = st.columns(2) # 新しいセクションのための列
-
-    with col1:
-        st.subheader("家族構成・基本設定")
-        # 家族メンバーの動的な追加・削除
-        if "members_count" not in st.session_state:
-            st.session_state.members_count = len(st.session_state.data["family"]["members"])
-        elif st.session_state.members_count != len(st.session_state.data["family"]["members"]):
-             st.session_state.members_count = len(st.session_state.data["family"]["members"])
-
-
-        for i in range(st.session_state.members_count):
-            st.markdown(f"**メンバー {i+1}**")
-            # メンバーリストが空の場合に備える
-            if i >= len(st.session_state.data["family"]["members"]):
-                st.session_state.data["family"]["members"].append({"name": "", "initial_age": 0})
-
-            # ここで、valueが確実に数値型であることを確認
-            current_initial_age = st.session_state.data["family"]["members"][i]["initial_age"]
-            if not isinstance(current_initial_age, (int, float)):
-                st.warning(f"Warning: Member {i+1} initial age was not numeric ({current_initial_age}). Setting to 0.")
-                current_initial_age = 0
-
-            member_name = st.text_input(f"名前", value=st.session_state.data["family"]["members"][i]["name"], key=f"member_name_{i}")
-            member_age = st.number_input(f"初期年齢", min_value=0, max_value=100, value=current_initial_age, step=1, key=f"member_age_{i}")
-            st.session_state.data["family"]["members"][i]["name"] = member_name
-            st.session_state.data["family"]["members"][i]["initial_age"] = member_age
-
-        if st.button("メンバーを追加", key="add_member_btn"):
-            st.session_state.data["family"]["members"].append({"name": f"New Member {st.session_state.members_count + 1}", "initial_age": 0})
-            st.session_state.members_count += 1
-            st.rerun()
-
-        if st.session_state.members_count > 0 and st.button("最後のメンバーを削除", key="remove_member_btn"):
-            st.session_state.data["family"]["members"].pop()
-            st.session_state.members_count -= 1
-            st.rerun()
-
-        st.session_state.data["family"]["years_to_simulate"] = st.number_input(
-            "シミュレーション年数 (年)",
-            min_value=5, max_value=60, value=st.session_state.data["family"]["years_to_simulate"], step=5, key="years_input"
-        )
-        st.session_state.data["family"]["initial_assets"] = st.number_input(
-            "初期資産 (万円)",
-            min_value=0, value=st.session_state.data["family"]["initial_assets"], step=100, key="initial_assets_input"
-        )
-        st.session_state.data["family"]["investment_return_rate"] = st.number_input(
-            "年間投資利回り (%)",
-            min_value=0.0, max_value=20.0, value=st.session_state.data["family"]["investment_return_rate"] * 100, step=0.1, format="%.1f", key="investment_rate_input"
-        ) / 100
-        st.session_state.data["family"]["inflation_rate"] = st.number_input(
-            "年間インフレ率 (%)",
-            min_value=0.0, max_value=10.0, value=st.session_state.data["family"]["inflation_rate"] * 100, step=0.1, format="%.1f", key="inflation_rate_input"
-        ) / 100
-        st.session_state.data["family"]["income_growth_rate"] = st.number_input(
-            "収入上昇率 (%)",
-            min_value=0.0, max_value=10.0, value=st.session_state.data["family"]["income_growth_rate"] * 100, step=0.1, format="%.1f", key="income_growth_rate_input"
-        ) / 100
-        st.session_state.data["family"]["income_growth_step_years"] = st.number_input(
-            "上昇率の発生するステップ年数 (年)",
-            min_value=1, max_value=30, value=st.session_state.data["family"]["income_growth_step_years"], step=1, key="income_growth_step_years_input"
-        )
+    # 家族メンバー・保険・その他一時支出金の動的な追加・削除
+    if "members_count" not in st.session_state:
+        st.session_state.members_count = len(st.session_state.data["family"]["members"])
+    elif st.session_state.members_count != len(st.session_state.data["family"]["members"]):
+         st.session_state.members_count = len(st.session_state.data["family"]["members"])
+
+    if "insurance_count" not in st.session_state:
+        st.session_state.insurance_count = len(st.session_state.data["insurance_policies"])
+    elif st.session_state.insurance_count != len(st.session_state.data["insurance_policies"]):
+        st.session_state.insurance_count = len(st.session_state.data["insurance_policies"])
+
+    if "other_lump_expenditures_count" not in st.session_state:
+        st.session_state.other_lump_expenditures_count = len(st.session_state.data["other_lump_expenditures"])
+    elif st.session_state.other_lump_expenditures_count != len(st.session_state.data["other_lump_expenditures"]):
+        st.session_state.other_lump_expenditures_count = len(st.session_state.data["other_lump_expenditures"])
+
+    # フォーム内にはボタンを置けないため、追加・削除ボタンはフォームの外に配置する
+    add_remove_col1, add_remove_col2, add_remove_col3 = st.columns(3)
+    with add_remove_col1:
+        st.button("メンバーを追加", key="add_member_btn", on_click=add_member)
+        if st.session_state.members_count > 0:
+            st.button("最後のメンバーを削除", key="remove_member_btn", on_click=remove_last_member)
+
+    with add_remove_col2:
+        st.button("保険を追加", key="add_insurance_btn", on_click=add_insurance_policy)
+        if st.session_state.insurance_count > 0:
+            st.button("最後の保険を削除", key="remove_insurance_btn", on_click=remove_last_insurance_policy)
+
+    with add_remove_col3:
+        st.button("その他一時支出金を追加", key="add_other_lump_expenditure_btn", on_click=add_other_lump_expenditure)
+        if st.session_state.other_lump_expenditures_count > 0:
+            st.button("最後のその他一時支出金を削除", key="remove_other_lump_expenditure_btn", on_click=remove_last_other_lump_expenditure)
+
+    # 入力値の変更ごとに再実行されないよう、設定項目はフォームにまとめ、実行ボタンでまとめて反映する
+    with st.form("lifeplan_form"):
+        col1, col2, col3 = st.columns(3)
+        col4, col5 = st.columns(2) # 新しいセクションのための列
+
+        with col1:
+            st.subheader("家族構成・基本設定")
+            fam = st.session_state.data["family"]
+            members = fam["members"]
+            for i in range(st.session_state.members_count):
+                st.markdown(f"**メンバー {i+1}**")
+                # メンバーリストが空の場合に備える
+                if i >= len(members):
+                    members.append({"name": "", "initial_age": 0})
+
+                m = members[i]
+                # ここで、valueが確実に数値型であることを確認
+                current_initial_age = m["initial_age"]
+                if not isinstance(current_initial_age, (int, float)):
+                    st.warning(f"Warning: Member {i+1} initial age was not numeric ({current_initial_age}). Setting to 0.")
+                    current_initial_age = 0
+
+                m["name"] = st.text_input(f"名前", value=m["name"], key=f"member_name_{i}")
+                m["initial_age"] = st.number_input(f"初期年齢", min_value=0, max_value=100, value=current_initial_age, step=1, key=f"member_age_{i}")
+
+            fam["years_to_simulate"] = st.number_input(
+                "シミュレーション年数 (年)",
+                min_value=5, max_value=60, value=fam["years_to_simulate"], step=5, key="years_input"
+            )
+            # 年を指定する入力欄の上限として、以降の列でも使い回す
+            max_years = fam["years_to_simulate"]
+            fam["initial_assets"] = st.number_input(
+                "初期資産 (万円)",
+                min_value=0, value=fam["initial_assets"], step=100, key="initial_assets_input"
+            )
+            fam["investment_return_rate"] = st.number_input(
+                "年間投資利回り (%)",
+                min_value=0.0, max_value=20.0, value=fam["investment_return_rate"] * 100, step=0.1, format="%.1f", key="investment_rate_input"
+            ) / 100
+            fam["inflation_rate"] = st.number_input(
+                "年間インフレ率 (%)",
+                min_value=0.0, max_value=10.0, value=fam["inflation_rate"] * 100, step=0.1, format="%.1f", key="inflation_rate_input"
+            ) / 100
+            fam["income_growth_rate"] = st.number_input(
+                "収入上昇率 (%)",
+                min_value=0.0, max_value=10.0, value=fam["income_growth_rate"] * 100, step=0.1, format="%.1f", key="income_growth_rate_input"
+            ) / 100
+            fam["income_growth_step_years"] = st.number_input(
+                "上昇率の発生するステップ年数 (年)",
+                min_value=1, max_value=30, value=fam["income_growth_step_years"], step=1, key="income_growth_step_years_input"
+            )
 
-    with col2:
-        st.subheader("収入")
-        st.session_state.data["income"]["monthly_salary_main"] = st.number_input(
-            "主たる月収 (万円)",
-            min_value=0, value=st.session_state.data["income"]["monthly_salary_main"], step=10, key="salary_main_input"
-        )
-        st.session_state.data["income"]["monthly_salary_sub"] = st.number_input(
-            "副業月収 (万円)",
-            min_value=0, value=st.session_state.data["income"]["monthly_salary_sub"], step=5, key="salary_sub_input"
-        )
-        st.session_state.data["income"]["bonus_annual"] = st.number_input(
-            "年間賞与 (万円)",
-            min_value=0, value=st.session_state.data["income"]["bonus_annual"], step=10, key="bonus_annual_input"
-        )
+        with col2:
+            st.subheader("収入")
+            st.session_state.data["income"]["monthly_salary_main"] = st.number_input(
+                "主たる月収 (万円)",
+                min_value=0, value=st.session_state.data["income"]["monthly_salary_main"], step=10, key="salary_main_input"
+            )
+            st.session_state.data["income"]["monthly_salary_sub"] = st.number_input(
+                "副業月収 (万円)",
+                min_value=0, value=st.session_state.data["income"]["monthly_salary_sub"], step=5, key="salary_sub_input"
+            )
+            st.session_state.data["income"]["bonus_annual"] = st.number_input(
+                "年間賞与 (万円)",
+                min_value=0, value=st.session_state.data["income"]["bonus_annual"], step=10, key="bonus_annual_input"
+            )
 
-        st.subheader("年齢に応じた収入変化 (最初のメンバーが到達時)")
-        st.markdown("※0の場合は基本収入が継続されます。")
-        st.session_state.data["income"]["monthly_salary_main_at_60"] = st.number_input("60歳時 主たる月収 (万円)", min_value=0, value=st.session_state.data["income"]["monthly_salary_main_at_60"], step=10, key="salary_main_60")
-        st.session_state.data["income"]["monthly_salary_sub_at_60"] = st.number_input("60歳時 副業月収 (万円)", min_value=0, value=st.session_state.data["income"]["monthly_salary_sub_at_60"], step=5, key="salary_sub_60")
-        st.session_state.data["income"]["bonus_annual_at_60"] = st.number_input("60歳時 年間賞与 (万円)", min_value=0, value=st.session_state.data["income"]["bonus_annual_at_60"], step=10, key="bonus_annual_60")
-        st.session_state.data["income"]["monthly_salary_main_at_65"] = st.number_input("65歳時 主たる月収 (万円)", min_value=0, value=st.session_state.data["income"]["monthly_salary_main_at_65"], step=10, key="salary_main_65")
-        st.session_state.data["income"]["monthly_salary_sub_at_65"] = st.number_input("65歳時 副業月収 (万円)", min_value=0, value=st.session_state.data["income"]["monthly_salary_sub_at_65"], step=5, key="salary_sub_65")
-        st.session_state.data["income"]["bonus_annual_at_65"] = st.number_input("65歳時 年間賞与 (万円)", min_value=0, value=st.session_state.data["income"]["bonus_annual_at_65"], step=10, key="bonus_annual_65")
-
-
-    with col3:
-        st.subheader("支出 (月額/千円)")
-        st.session_state.data["expenditure"]["housing"] = st.number_input("住居費 (千円)", min_value=0, value=st.session_state.data["expenditure"]["housing"], step=5, key="housing_input")
-        st.session_state.data["expenditure"]["food"] = st.number_input("食費 (千円)", min_value=0, value=st.session_state.data["expenditure"]["food"], step=1, key="food_input")
-        st.session_state.data["expenditure"]["transportation"] = st.number_input("交通費 (千円)", min_value=0, value=st.session_state.data["expenditure"]["transportation"], step=1, key="transportation_input")
-        st.session_state.data["expenditure"]["education"] = st.number_input("教育費 (千円)", min_value=0, value=st.session_state.data["expenditure"]["education"], step=1, key="education_input")
-        st.session_state.data["expenditure"]["utilities"] = st.number_input("光熱費 (千円)", min_value=0, value=st.session_state.data["expenditure"]["utilities"], step=1, key="utilities_input")
-        st.session_state.data["expenditure"]["communication"] = st.number_input("通信費 (千円)", min_value=0, value=st.session_state.data["expenditure"]["communication"], step=1, key="communication_input")
-        st.session_state.data["expenditure"]["leisure"] = st.number_input("娯楽費 (千円)", min_value=0, value=st.session_state.data["expenditure"]["leisure"], step=1, key="leisure_input")
-        st.session_state.data["expenditure"]["medical"] = st.number_input("医療費 (千円)", min_value=0, value=st.session_state.data["expenditure"]["medical"], step=1, key="medical_input")
-        st.session_state.data["expenditure"]["other"] = st.number_input("その他 (千円)", min_value=0, value=st.session_state.data["expenditure"]["other"], step=1, key="other_input")
-
-        st.subheader("年齢に応じた支出変化 (最初のメンバーが到達時)")
-        st.markdown("※0の場合は基本支出が継続されます。")
-        st.session_state.data["expenditure"]["housing_at_60"] = st.number_input("60歳時 住居費 (千円)", min_value=0, value=st.session_state.data["expenditure"]["housing_at_60"], step=5, key="housing_60")
-        st.session_state.data["expenditure"]["food_at_60"] = st.number_input("60歳時 食費 (千円)", min_value=0, value=st.session_state.data["expenditure"]["food_at_60"], step=1, key="food_60")
-        st.session_state.data["expenditure"]["transportation_at_60"] = st.number_input("60歳時 交通費 (千円)", min_value=0, value=st.session_state.data["expenditure"]["transportation_at_60"], step=1, key="transportation_60")
-        st.session_state.data["expenditure"]["education_at_60"] = st.number_input("60歳時 教育費 (千円)", min_value=0, value=st.session_state.data["expenditure"]["education_at_60"], step=1, key="education_60")
-        st.session_state.data["expenditure"]["utilities_at_60"] = st.number_input("60歳時 光熱費 (千円)", min_value=0, value=st.session_state.data["expenditure"]["utilities_at_60"], step=1, key="utilities_60")
-        st.session_state.data["expenditure"]["communication_at_60"] = st.number_input("60歳時 通信費 (千円)", min_value=0, value=st.session_state.data["expenditure"]["communication_at_60"], step=1, key="communication_60")
-        st.session_state.data["expenditure"]["leisure_at_60"] = st.number_input("60歳時 娯楽費 (千円)", min_value=0, value=st.session_state.data["expenditure"]["leisure_at_60"], step=1, key="leisure_60")
-        st.session_state.data["expenditure"]["medical_at_60"] = st.number_input("60歳時 医療費 (千円)", min_value=0, value=st.session_state.data["expenditure"]["medical_at_60"], step=1, key="medical_60")
-        st.session_state.data["expenditure"]["other_at_60"] = st.number_input("60歳時 その他 (千円)", min_value=0, value=st.session_state.data["expenditure"]["other_at_60"], step=1, key="other_60")
-
-        st.session_state.data["expenditure"]["housing_at_65"] = st.number_input("65歳時 住居費 (千円)", min_value=0, value=st.session_state.data["expenditure"]["housing_at_65"], step=5, key="housing_65")
-        st.session_state.data["expenditure"]["food_at_65"] = st.number_input("65歳時 食費 (千円)", min_value=0, value=st.session_state.data["expenditure"]["food_at_65"], step=1, key="food_65")
-        st.session_state.data["expenditure"]["transportation_at_65"] = st.number_input("65歳時 交通費 (千円)", min_value=0, value=st.session_state.data["expenditure"]["transportation_at_65"], step=1, key="transportation_65")
-        st.session_state.data["expenditure"]["education_at_65"] = st.number_input("65歳時 教育費 (千円)", min_value=0, value=st.session_state.data["expenditure"]["education_at_65"], step=1, key="education_65")
-        st.session_state.data["expenditure"]["utilities_at_65"] = st.number_input("65歳時 光熱費 (千円)", min_value=0, value=st.session_state.data["expenditure"]["utilities_at_65"], step=1, key="utilities_65")
-        st.session_state.data["expenditure"]["communication_at_65"] = st.number_input("65歳時 通信費 (千円)", min_value=0, value=st.session_state.data["expenditure"]["communication_at_65"], step=1, key="communication_65")
-        st.session_state.data["expenditure"]["leisure_at_65"] = st.number_input("65歳時 娯楽費 (千円)", min_value=0, value=st.session_state.data["expenditure"]["leisure_at_65"], step=1, key="leisure_65")
-        st.session_state.data["expenditure"]["medical_at_65"] = st.number_input("65歳時 医療費 (千円)", min_value=0, value=st.session_state.data["expenditure"]["medical_at_65"], step=1, key="medical_65")
-        st.session_state.data["expenditure"]["other_at_65"] = st.number_input("65歳時 その他 (千円)", min_value=0, value=st.session_state.data["expenditure"]["other_at_65"], step=1, key="other_65")
-
-
-    with col4:
-        st.subheader("学校費用設定 (万円)")
-        st.markdown("各学校の入学時費用と在学中の年間費用です。")
-        school_types_jp = {
-            "kindergarten": "幼稚園",
-            "elementary_school": "小学校",
-            "junior_high_school": "中学校",
-            "high_school": "高校",
-            "university": "大学"
-        }
-        for school_key, school_info in st.session_state.data["school_lump_sums"].items():
-            jp_name = school_types_jp.get(school_key, school_key.replace('_', ' ').title())
-            st.markdown(f"**{jp_name}**")
-            st.session_state.data["school_lump_sums"][school_key]["amount"] = st.number_input(
-                f"{jp_name} 入学時費用",
-                min_value=0, value=school_info["amount"], step=10, key=f"school_{school_key}_amount"
+            st.subheader("年齢に応じた収入変化 (最初のメンバーが到達時)")
+            st.markdown("※0の場合は基本収入が継続されます。")
+            st.session_state.data["income"]["monthly_salary_main_at_60"] = st.number_input("60歳時 主たる月収 (万円)", min_value=0, value=st.session_state.data["income"]["monthly_salary_main_at_60"], step=10, key="salary_main_60")
+            st.session_state.data["income"]["monthly_salary_sub_at_60"] = st.number_input("60歳時 副業月収 (万円)", min_value=0, value=st.session_state.data["income"]["monthly_salary_sub_at_60"], step=5, key="salary_sub_60")
+            st.session_state.data["income"]["bonus_annual_at_60"] = st.number_input("60歳時 年間賞与 (万円)", min_value=0, value=st.session_state.data["income"]["bonus_annual_at_60"], step=10, key="bonus_annual_60")
+            st.session_state.data["income"]["monthly_salary_main_at_65"] = st.number_input("65歳時 主たる月収 (万円)", min_value=0, value=st.session_state.data["income"]["monthly_salary_main_at_65"], step=10, key="salary_main_65")
+            st.session_state.data["income"]["monthly_salary_sub_at_65"] = st.number_input("65歳時 副業月収 (万円)", min_value=0, value=st.session_state.data["income"]["monthly_salary_sub_at_65"], step=5, key="salary_sub_65")
+            st.session_state.data["income"]["bonus_annual_at_65"] = st.number_input("65歳時 年間賞与 (万円)", min_value=0, value=st.session_state.data["income"]["bonus_annual_at_65"], step=10, key="bonus_annual_65")
+
+
+        with col3:
+            st.subheader("支出 (月額/千円)")
+            st.session_state.data["expenditure"]["housing"] = st.number_input("住居費 (千円)", min_value=0, value=st.session_state.data["expenditure"]["housing"], step=5, key="housing_input")
+            st.session_state.data["expenditure"]["food"] = st.number_input("食費 (千円)", min_value=0, value=st.session_state.data["expenditure"]["food"], step=1, key="food_input")
+            st.session_state.data["expenditure"]["transportation"] = st.number_input("交通費 (千円)", min_value=0, value=st.session_state.data["expenditure"]["transportation"], step=1, key="transportation_input")
+            st.session_state.data["expenditure"]["education"] = st.number_input("教育費 (千円)", min_value=0, value=st.session_state.data["expenditure"]["education"], step=1, key="education_input")
+            st.session_state.data["expenditure"]["utilities"] = st.number_input("光熱費 (千円)", min_value=0, value=st.session_state.data["expenditure"]["utilities"], step=1, key="utilities_input")
+            st.session_state.data["expenditure"]["communication"] = st.number_input("通信費 (千円)", min_value=0, value=st.session_state.data["expenditure"]["communication"], step=1, key="communication_input")
+            st.session_state.data["expenditure"]["leisure"] = st.number_input("娯楽費 (千円)", min_value=0, value=st.session_state.data["expenditure"]["leisure"], step=1, key="leisure_input")
+            st.session_state.data["expenditure"]["medical"] = st.number_input("医療費 (千円)", min_value=0, value=st.session_state.data["expenditure"]["medical"], step=1, key="medical_input")
+            st.session_state.data["expenditure"]["other"] = st.number_input("その他 (千円)", min_value=0, value=st.session_state.data["expenditure"]["other"], step=1, key="other_input")
+
+            st.subheader("年齢に応じた支出変化 (最初のメンバーが到達時)")
+            st.markdown("※0の場合は基本支出が継続されます。")
+            st.session_state.data["expenditure"]["housing_at_60"] = st.number_input("60歳時 住居費 (千円)", min_value=0, value=st.session_state.data["expenditure"]["housing_at_60"], step=5, key="housing_60")
+            st.session_state.data["expenditure"]["food_at_60"] = st.number_input("60歳時 食費 (千円)", min_value=0, value=st.session_state.data["expenditure"]["food_at_60"], step=1, key="food_60")
+            st.session_state.data["expenditure"]["transportation_at_60"] = st.number_input("60歳時 交通費 (千円)", min_value=0, value=st.session_state.data["expenditure"]["transportation_at_60"], step=1, key="transportation_60")
+            st.session_state.data["expenditure"]["education_at_60"] = st.number_input("60歳時 教育費 (千円)", min_value=0, value=st.session_state.data["expenditure"]["education_at_60"], step=1, key="education_60")
+            st.session_state.data["expenditure"]["utilities_at_60"] = st.number_input("60歳時 光熱費 (千円)", min_value=0, value=st.session_state.data["expenditure"]["utilities_at_60"], step=1, key="utilities_60")
+            st.session_state.data["expenditure"]["communication_at_60"] = st.number_input("60歳時 通信費 (千円)", min_value=0, value=st.session_state.data["expenditure"]["communication_at_60"], step=1, key="communication_60")
+            st.session_state.data["expenditure"]["leisure_at_60"] = st.number_input("60歳時 娯楽費 (千円)", min_value=0, value=st.session_state.data["expenditure"]["leisure_at_60"], step=1, key="leisure_60")
+            st.session_state.data["expenditure"]["medical_at_60"] = st.number_input("60歳時 医療費 (千円)", min_value=0, value=st.session_state.data["expenditure"]["medical_at_60"], step=1, key="medical_60")
+            st.session_state.data["expenditure"]["other_at_60"] = st.number_input("60歳時 その他 (千円)", min_value=0, value=st.session_state.data["expenditure"]["other_at_60"], step=1, key="other_60")
+
+            st.session_state.data["expenditure"]["housing_at_65"] = st.number_input("65歳時 住居費 (千円)", min_value=0, value=st.session_state.data["expenditure"]["housing_at_65"], step=5, key="housing_65")
+            st.session_state.data["expenditure"]["food_at_65"] = st.number_input("65歳時 食費 (千円)", min_value=0, value=st.session_state.data["expenditure"]["food_at_65"], step=1, key="food_65")
+            st.session_state.data["expenditure"]["transportation_at_65"] = st.number_input("65歳時 交通費 (千円)", min_value=0, value=st.session_state.data["expenditure"]["transportation_at_65"], step=1, key="transportation_65")
+            st.session_state.data["expenditure"]["education_at_65"] = st.number_input("65歳時 教育費 (千円)", min_value=0, value=st.session_state.data["expenditure"]["education_at_65"], step=1, key="education_65")
+            st.session_state.data["expenditure"]["utilities_at_65"] = st.number_input("65歳時 光熱費 (千円)", min_value=0, value=st.session_state.data["expenditure"]["utilities_at_65"], step=1, key="utilities_65")
+            st.session_state.data["expenditure"]["communication_at_65"] = st.number_input("65歳時 通信費 (千円)", min_value=0, value=st.session_state.data["expenditure"]["communication_at_65"], step=1, key="communication_65")
+            st.session_state.data["expenditure"]["leisure_at_65"] = st.number_input("65歳時 娯楽費 (千円)", min_value=0, value=st.session_state.data["expenditure"]["leisure_at_65"], step=1, key="leisure_65")
+            st.session_state.data["expenditure"]["medical_at_65"] = st.number_input("65歳時 医療費 (千円)", min_value=0, value=st.session_state.data["expenditure"]["medical_at_65"], step=1, key="medical_65")
+            st.session_state.data["expenditure"]["other_at_65"] = st.number_input("65歳時 その他 (千円)", min_value=0, value=st.session_state.data["expenditure"]["other_at_65"], step=1, key="other_65")
+
+
+        with col4:
+            st.subheader("学校費用設定 (万円)")
+            st.markdown("各学校の入学時費用と在学中の年間費用です。")
+            school_types_jp = {
+                "kindergarten": "幼稚園",
+                "elementary_school": "小学校",
+                "junior_high_school": "中学校",
+                "high_school": "高校",
+                "university": "大学"
+            }
+            for school_key, school_info in st.session_state.data["school_lump_sums"].items():
+                jp_name = school_types_jp.get(school_key, school_key.replace('_', ' ').title())
+                st.markdown(f"**{jp_name}**")
+                st.session_state.data["school_lump_sums"][school_key]["amount"] = st.number_input(
+                    f"{jp_name} 入学時費用",
+                    min_value=0, value=school_info["amount"], step=10, key=f"school_{school_key}_amount"
+                )
+                st.session_state.data["school_lump_sums"][school_key]["start_age"] = st.number_input(
+                    f"{jp_name} 開始年齢",
+                    min_value=0, max_value=30, value=school_info["start_age"], step=1, key=f"school_{school_key}_age"
+                )
+                st.session_state.data["school_lump_sums"][school_key]["duration"] = st.number_input(
+                    f"{jp_name} 在学期間 (年)",
+                    min_value=0, max_value=10, value=school_info["duration"], step=1, key=f"school_{school_key}_duration"
+                )
+                st.session_state.data["school_lump_sums"][school_key]["annual_cost"] = st.number_input(
+                    f"{jp_name} 年間在学費用",
+                    min_value=0, value=school_info["annual_cost"], step=10, key=f"school_{school_key}_annual_cost"
+                )
+
+            st.subheader("住宅ローン設定")
+            st.session_state.data["housing_loan"]["loan_amount"] = st.number_input(
+                "借入額 (万円)",
+                min_value=0, value=st.session_state.data["housing_loan"]["loan_amount"], step=100, key="loan_amount_input"
             )
-            st.session_state.data["school_lump_sums"][school_key]["start_age"] = st.number_input(
-                f"{jp_name} 開始年齢",
-                min_value=0, max_value=30, value=school_info["start_age"], step=1, key=f"school_{school_key}_age"
+            st.session_state.data["housing_loan"]["loan_interest_rate"] = st.number_input(
+                "年間金利 (%)",
+                min_value=0.0, max_value=10.0, value=st.session_state.data["housing_loan"]["loan_interest_rate"] * 100, step=0.01, format="%.2f", key="loan_interest_rate_input"
+            ) / 100
+            st.session_state.data["housing_loan"]["loan_term_years"] = st.number_input(
+                "返済期間 (年)",
+                min_value=0, max_value=50, value=st.session_state.data["housing_loan"]["loan_term_years"], step=1, key="loan_term_years_input"
             )
-            st.session_state.data["school_lump_sums"][school_key]["duration"] = st.number_input(
-                f"{jp_name} 在学期間 (年)",
-                min_value=0, max_value=10, value=school_info["duration"], step=1, key=f"school_{school_key}_duration"
+            st.session_state.data["housing_loan"]["start_year"] = st.number_input(
+                "返済開始年 (シミュレーション開始から)",
+                min_value=1, max_value=max_years, value=st.session_state.data["housing_loan"]["start_year"], step=1, key="loan_start_year_input"
             )
-            st.session_state.data["school_lump_sums"][school_key]["annual_cost"] = st.number_input(
-                f"{jp_name} 年間在学費用",
-                min_value=0, value=school_info["annual_cost"], step=10, key=f"school_{school_key}_annual_cost"
+            monthly_loan_payment_for_display = calculate_monthly_loan_payment( # 変数名を明確化
+                st.session_state.data["housing_loan"]["loan_amount"],
+                st.session_state.data["housing_loan"]["loan_interest_rate"],
+                st.session_state.data["housing_loan"]["loan_term_years"]
             )
-
-        st.subheader("住宅ローン設定")
-        st.session_state.data["housing_loan"]["loan_amount"] = st.number_input(
-            "借入額 (万円)",
-            min_value=0, value=st.session_state.data["housing_loan"]["loan_amount"], step=100, key="loan_amount_input"
-        )
-        st.session_state.data["housing_loan"]["loan_interest_rate"] = st.number_input(
-            "年間金利 (%)",
-            min_value=0.0, max_value=10.0, value=st.session_state.data["housing_loan"]["loan_interest_rate"] * 100, step=0.01, format="%.2f", key="loan_interest_rate_input"
-        ) / 100
-        st.session_state.data["housing_loan"]["loan_term_years"] = st.number_input(
-            "返済期間 (年)",
-            min_value=0, max_value=50, value=st.session_state.data["housing_loan"]["loan_term_years"], step=1, key="loan_term_years_input"
-        )
-        st.session_state.data["housing_loan"]["start_year"] = st.number_input(
-            "返済開始年 (シミュレーション開始から)",
-            min_value=1, max_value=st.session_state.data["family"]["years_to_simulate"], value=st.session_state.data["housing_loan"]["start_year"], step=1, key="loan_start_year_input"
-        )
-        monthly_loan_payment_for_display = calculate_monthly_loan_payment( # 変数名を明確化
-            st.session_state.data["housing_loan"]["loan_amount"],
-            st.session_state.data["housing_loan"]["loan_interest_rate"],
-            st.session_state.data["housing_loan"]["loan_term_years"]
-        )
-        st.info(f"**月々のローン返済額 (目安):** {int(monthly_loan_payment_for_display):,} 円")
-
-        # 住宅ローンの金利合計額を表示
-        if st.session_state.data["housing_loan"]["loan_amount"] > 0 and st.session_state.data["housing_loan"]["loan_term_years"] > 0:
-            # monthly_loan_payment_for_display を利用して計算
-            total_loan_payments_yen = monthly_loan_payment_for_display * (st.session_state.data["housing_loan"]["loan_term_years"] * 12)
-            total_interest_paid_yen = total_loan_payments_yen - (st.session_state.data["housing_loan"]["loan_amount"] * 10000)
-            st.info(f"**住宅ローンの金利合計額:** {int(total_interest_paid_yen):,} 円")
-
-
-    with col5:
-        st.subheader("保険設定")
-        # 保険の動的な追加・削除
-        if "insurance_count" not in st.session_state:
-            st.session_state.insurance_count = len(st.session_state.data["insurance_policies"])
-        elif st.session_state.insurance_count != len(st.session_state.data["insurance_policies"]):
-            st.session_state.insurance_count = len(st.session_state.data["insurance_policies"])
-
-
-        for i in range(st.session_state.insurance_count):
-            st.markdown(f"**保険 {i+1}**")
-            if i >= len(st.session_state.data["insurance_policies"]):
-                st.session_state.data["insurance_policies"].append({"name": "", "monthly_premium": 0, "maturity_year": 0, "payout_amount": 0, "start_year": 1})
-
-            policy = st.session_state.data["insurance_policies"][i]
-            policy["name"] = st.text_input(f"保険名", value=policy["name"], key=f"ins_name_{i}")
-            policy["monthly_premium"] = st.number_input(f"月額保険料 (円)", min_value=0, value=policy["monthly_premium"], step=1000, key=f"ins_premium_{i}")
-            # 満期年数を「支払い開始年からの年数」として入力
-            policy["maturity_year"] = st.number_input(f"満期年数 (支払い開始年からの年数)", min_value=0, max_value=st.session_state.data["family"]["years_to_simulate"], value=policy["maturity_year"], step=1, key=f"ins_maturity_year_{i}")
-            policy["payout_amount"] = st.number_input(f"満期時の受取額 (万円)", min_value=0, value=policy["payout_amount"], step=10, key=f"ins_payout_{i}")
-            policy["start_year"] = st.number_input(f"支払い開始年 (シミュレーション開始から)", min_value=1, max_value=st.session_state.data["family"]["years_to_simulate"], value=policy["start_year"], step=1, key=f"ins_start_year_{i}")
-
-        if st.button("保険を追加", key="add_insurance_btn"):
-            st.session_state.data["insurance_policies"].append({"name": f"新規保険 {st.session_state.insurance_count + 1}", "monthly_premium": 0, "maturity_year": 0, "payout_amount": 0, "start_year": 1})
-            st.session_state.insurance_count += 1
-            st.rerun()
-
-        if st.session_state.insurance_count > 0 and st.button("最後の保険を削除", key="remove_insurance_btn"):
-            st.session_state.data["insurance_policies"].pop()
-            st.session_state.other_lump_expenditures_count -= 1 # ここが誤りだったため修正
-            st.rerun()
-
-        st.subheader("その他一時支出金")
-        # その他一時支出金の動的な追加・削除
-        if "other_lump_expenditures_count" not in st.session_state:
-            st.session_state.other_lump_expenditures_count = len(st.session_state.data["other_lump_expenditures"])
-        elif st.session_state.other_lump_expenditures_count != len(st.session_state.data["other_lump_expenditures"]):
-            st.session_state.other_lump_expenditures_count = len(st.session_state.data["other_lump_expenditures"])
-
-        for i in range(st.session_state.other_lump_expenditures_count):
-            st.markdown(f"**一時支出 {i+1}**")
-            if i >= len(st.session_state.data["other_lump_expenditures"]):
-                st.session_state.data["other_lump_expenditures"].append({"name": "", "amount": 0, "year": 0})
-
-            lump_sum_item = st.session_state.data["other_lump_expenditures"][i]
-            lump_sum_item["name"] = st.text_input(f"一時支出名", value=lump_sum_item["name"], key=f"other_lump_expenditure_name_{i}")
-            lump_sum_item["amount"] = st.number_input(f"金額 (万円)", min_value=0, value=lump_sum_item["amount"], step=10, key=f"other_lump_expenditure_amount_{i}")
-            lump_sum_item["year"] = st.number_input(f"発生年 (シミュレーション開始から)", min_value=0, max_value=st.session_state.data["family"]["years_to_simulate"], value=lump_sum_item["year"], step=1, key=f"other_lump_expenditure_year_{i}")
-
-        if st.button("その他一時支出金を追加", key="add_other_lump_expenditure_btn"):
-            st.session_state.data["other_lump_expenditures"].append({"name": f"新規一時支出 {st.session_state.other_lump_expenditures_count + 1}", "amount": 0, "year": 0})
-            st.session_state.other_lump_expenditures_count += 1
-            st.rerun()
-
-        if st.session_state.other_lump_expenditures_count > 0 and st.button("最後のその他一時支出金を削除", key="remove_other_lump_expenditure_btn"):
-            st.session_state.data["other_lump_expenditures"].pop()
-            st.session_state.other_lump_expenditures_count -= 1
-            st.rerun()
-
-
-    # --- シミュレーション実行ボタン ---
-    st.markdown("---")
-    if st.button("シミュレーションを実行", type="primary"):
-        st.session_state.run_simulation = True
-    else:
-        # 初期状態またはボタンが押されていない場合はシミュレーション結果をクリア
-        if "simulation_df" not in st.session_state:
-            st.session_state.simulation_df = pd.DataFrame()
-        st.session_state.run_simulation = False
+            st.info(f"**月々のローン返済額 (目安):** {int(monthly_loan_payment_for_display):,} 円")
+
+            # 住宅ローンの金利合計額を表示
+            if st.session_state.data["housing_loan"]["loan_amount"] > 0 and st.session_state.data["housing_loan"]["loan_term_years"] > 0:
+                # monthly_loan_payment_for_display を利用して計算
+                total_loan_payments_yen = monthly_loan_payment_for_display * (st.session_state.data["housing_loan"]["loan_term_years"] * 12)
+                total_interest_paid_yen = total_loan_payments_yen - (st.session_state.data["housing_loan"]["loan_amount"] * 10000)
+                st.info(f"**住宅ローンの金利合計額:** {int(total_interest_paid_yen):,} 円")
+
+
+        with col5:
+            st.subheader("保険設定")
+            ins = st.session_state.data["insurance_policies"]
+            for i in range(st.session_state.insurance_count):
+                st.markdown(f"**保険 {i+1}**")
+                if i >= len(ins):
+                    ins.append({"name": "", "monthly_premium": 0, "maturity_year": 0, "payout_amount": 0, "start_year": 1})
+
+                policy = ins[i]
+                seed_insurance_widget_state(i, policy)
+                policy["name"] = st.text_input(f"保険名", key=f"ins_name_{i}")
+                policy["monthly_premium"] = st.number_input(f"月額保険料 (円)", min_value=0, step=1000, key=f"ins_premium_{i}")
+                # 満期年数を「支払い開始年からの年数」として入力
+                policy["maturity_year"] = st.number_input(f"満期年数 (支払い開始年からの年数)", min_value=0, max_value=max_years, step=1, key=f"ins_maturity_year_{i}")
+                policy["payout_amount"] = st.number_input(f"満期時の受取額 (万円)", min_value=0, step=10, key=f"ins_payout_{i}")
+                policy["start_year"] = st.number_input(f"支払い開始年 (シミュレーション開始から)", min_value=1, max_value=max_years, step=1, key=f"ins_start_year_{i}")
+
+            st.subheader("その他一時支出金")
+            lumps = st.session_state.data["other_lump_expenditures"]
+            for i in range(st.session_state.other_lump_expenditures_count):
+                st.markdown(f"**一時支出 {i+1}**")
+                if i >= len(lumps):
+                    lumps.append({"name": "", "amount": 0, "year": 0})
+
+                lump_sum_item = lumps[i]
+                lump_sum_item["name"] = st.text_input(f"一時支出名", value=lump_sum_item["name"], key=f"other_lump_expenditure_name_{i}")
+                lump_sum_item["amount"] = st.number_input(f"金額 (万円)", min_value=0, value=lump_sum_item["amount"], step=10, key=f"other_lump_expenditure_amount_{i}")
+                lump_sum_item["year"] = st.number_input(f"発生年 (シミュレーション開始から)", min_value=0, max_value=max_years, value=lump_sum_item["year"], step=1, key=f"other_lump_expenditure_year_{i}")
+
+        # --- シミュレーション実行ボタン ---
+        st.markdown("---")
+        submitted = st.form_submit_button("シミュレーションを実行", type="primary")
+
+    # シミュレーション未実行の状態は None で表す
+    st.session_state.setdefault("simulation_df", None)
+
+    # シミュレーションは入力内容が前回の実行時から変わった場合にだけ行う
+    input_hash = hash_data(st.session_state.data)
+    if submitted and input_hash != st.session_state.get("sim_input_hash"):
+        simulation_df = simulate_life_plan(st.session_state.data)
+        st.session_state.simulation_df = simulation_df # 結果をセッションステートに保存
+        # 最終年の年末資産もシミュレーション時に1度だけ取り出して保存しておく
+        st.session_state.final_assets = int(simulation_df['年末資産'].iloc[-1]) if not simulation_df.empty else 0
+        st.session_state.sim_input_hash = input_hash
 
 
     # --- シミュレーション結果 ---
@@ -955,94 +1350,25 @@ def main():
     st.markdown("設定したライフプランに基づいた将来の資産推移です。")
     st.markdown("※「月額支出合計」「保険支出」「住宅ローン額」「学校一時金」「学校在学費用」「その他一時支出金」「保険満期金」は、それぞれの支出項目からの**再掲**です。")
 
-    if st.session_state.run_simulation:
-        simulation_df = simulate_life_plan(st.session_state.data)
-        st.session_state.simulation_df = simulation_df # 結果をセッションステートに保存
-
-        # スタイル適用
-        # formatを最初に適用
-        styled_df = simulation_df.style.format({
-            "年間収入": "{:,}円",
-            "年間支出": "{:,}円",
-            "年間収支": "{:,}円",
-            "年末資産": "{:,}円",
-            "月額支出合計（再掲）": "{:,}円",
-            "保険支出（再掲）": "{:,}円",
-            "住宅ローン額（再掲）": "{:,}円",
-            "学校一時金（再掲）": "{:,}円",
-            "学校在学費用（再掲）": "{:,}円",
-            "その他一時支出金（再掲）": "{:,}円",
-            "保険満期金（再掲）": "{:,}円",
-            # メンバー年齢の列は自動的に表示されるため、ここでは特別なフォーマットは不要
-        })
-        
-        # 再掲列の文字色
-        styled_df = styled_df.apply(apply_rekei_style, axis=0) # axis=0 で列全体に適用
-        
-        # 年間収支がマイナスのセルの文字色
-        styled_df = styled_df.applymap(apply_negative_balance_style, subset=['年間収支'])
-
-        # メンバーの年齢が65歳の場合のセルの文字色
-        member_age_cols = [col for col in simulation_df.columns if "年齢" in col]
-        if member_age_cols: # メンバー年齢列が存在する場合のみ適用
-            styled_df = styled_df.applymap(apply_65_age_style, subset=member_age_cols)
-
-
-        st.dataframe(styled_df, use_container_width=True)
-
-        # グラフの線の色を条件付きで変更
-        line_chart_color_hex = "#1f77b4" # デフォルトの青色 (Streamlitのデフォルトに合わせる)
-        if not simulation_df.empty and simulation_df['年末資産'].min() < 0:
-            line_chart_color_hex = "#ff0000" # 赤字になったら赤色にする
-
-        # Streamlitのline_chartのcolor引数は、単一のSeriesの場合でもリストで渡すのが安全
-        st.line_chart(simulation_df.set_index("年")["年末資産"], color=[line_chart_color_hex])
-
-        # マイナスになる年数と最大マイナス額の表示
-        negative_assets_df = simulation_df[simulation_df['年末資産'] < 0]
-        if not negative_assets_df.empty:
-            first_negative_year = negative_assets_df['年'].iloc[0]
-            max_negative_amount = negative_assets_df['年末資産'].min()
-            st.error(f"**資産がマイナスになる年数:** {first_negative_year}年目")
-            st.error(f"**最大マイナス額:** {max_negative_amount:,}円")
-        else:
-            st.success("**シミュレーション期間中、資産がマイナスになることはありませんでした。**")
-            st.markdown(f"**最終的な年末資産:** {simulation_df['年末資産'].iloc[-1]:,}円")
+    # 結果はセッションステートに保存されている限り、他の操作による再実行でも表示し続ける
+    if st.session_state.simulation_df is not None and not st.session_state.simulation_df.empty:
+        if input_hash != st.session_state.sim_input_hash:
+            st.warning("入力内容が変更されています。「シミュレーションを実行」ボタンを押して結果を更新してください。")
+        render_simulation_results(st.session_state.simulation_df)
 
     else:
         st.info("「シミュレーションを実行」ボタンを押して結果を表示してください。")
 
 
     # ダウンロードボタン
-    # 現在のデータをCSV形式に変換
-    df_to_download = pd.DataFrame(flatten_data_for_csv(st.session_state.data))
-    csv = df_to_download.to_csv(index=False).encode('utf-8')
-    st.download_button(
-        label="現在のライフプランデータをダウンロード (CSV)",
-        data=csv,
-        file_name="life_plan_data.csv",
-        mime="text/csv",
-    )
+    render_download_button()
 
     # --- AIによる改善提案 ---
     st.header("4. AIによる改善提案")
     st.markdown("あなたのライフプランに関する情報を入力すると、AIが改善点を提案します。")
     st.info("AIによる改善提案は、現在**定型文**であることを記載しています。")
 
-    user_plan_description = st.text_area(
-        "あなたのライフプランについて、目標や課題、現在の状況などを具体的に教えてください。",
-        value="現在の収入と支出で、20年後に老後資金として5,000万円を貯蓄したいと考えています。何か改善できる点はありますか？",
-        height=150
-    )
-
-    if st.button("AIに改善点を尋ねる"):
-        if user_plan_description and "simulation_df" in st.session_state and not st.session_state.simulation_df.empty:
-            with st.spinner("AIが改善点を考えています..."):
-                # シミュレーション結果と現在のデータをAI関数に渡す
-                suggestion = asyncio.run(get_gemini_suggestion(user_plan_description, st.session_state.simulation_df, st.session_state.data))
-                st.markdown(suggestion)
-        else:
-            st.warning("ライフプランの説明を入力し、「シミュレーションを実行」してからAIに尋ねてください。")
+    render_ai_section()
 
 
 if __name__ == "__main__":